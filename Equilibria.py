@@ -0,0 +1,409 @@
+"""
+Equilibria - A module for computing Nash equilibria of games, using numpy.
+"""
+
+import numpy as np
+from itertools import combinations
+from games import MixedStrategy, MixedStateBasedStrategy
+
+###################
+# PURE EQUILIBRIA #
+###################
+
+def pure_equilibrium_mask(mats):
+    """
+    Returns a boolean mask over the joint actions of one or more games,
+    marking the pure Nash equilibria. A joint action is an equilibrium if
+    every player's payoff is maximal along the player's own axis.
+
+    Keyword arguments
+    mats -- a payoff ndarray of shape (n_1, ..., n_m, m), or a stack of
+    such ndarrays of shape (k, n_1, ..., n_m, m)
+    """
+    mats = np.asarray(mats)
+    players = mats.shape[-1]
+    offset = mats.ndim - 1 - players
+    mask = np.ones(mats.shape[:-1], dtype=bool)
+    for i in range(players):
+        payoff = mats[..., i]
+        mask &= payoff >= np.max(payoff, axis=offset+i, keepdims=True)
+    return mask
+
+def pure_equilibria(game):
+    """Returns the pure Nash equilibria of a Game as an integer ndarray of
+    shape (k, players), one joint action per row."""
+    return np.argwhere(pure_equilibrium_mask(game.mat))
+
+##################
+# BIMATRIX GAMES #
+##################
+
+def _bimatrix(game):
+    if game.players != 2:
+        raise ValueError("Game must have two players.")
+    return game.mat[..., 0], game.mat[..., 1]
+
+def support_enumeration(game, tol=1e-9):
+    """
+    Returns the Nash equilibria of a nondegenerate two-player Game as a list
+    of pairs (x, y) of mixed strategies, by enumerating supports of equal
+    size. For each size, the indifference systems of all pairs of supports
+    are stacked and solved in one batched call.
+    """
+    A, B = _bimatrix(game)
+    m, n = A.shape
+    equilibria = []
+    for k in range(1, min(m, n)+1):
+        rows = np.array(list(combinations(range(m), k)))
+        cols = np.array(list(combinations(range(n), k)))
+        I = np.repeat(rows, len(cols), axis=0)
+        J = np.tile(cols, (len(rows), 1))
+
+        # Solve A[I,J] y = v, sum(y) = 1 and x B[I,J] = u, sum(x) = 1
+        sub_a = A[I[:, :, None], J[:, None, :]]
+        sub_b = B[I[:, :, None], J[:, None, :]]
+        y, ok_y = _indifference(sub_a)
+        x, ok_x = _indifference(np.swapaxes(sub_b, 1, 2))
+        ok = ok_x & ok_y & np.all(x >= -tol, axis=1) & \
+                np.all(y >= -tol, axis=1)
+
+        for p in np.flatnonzero(ok):
+            xs = np.zeros(m)
+            ys = np.zeros(n)
+            xs[I[p]] = np.clip(x[p], 0, None)
+            ys[J[p]] = np.clip(y[p], 0, None)
+            xs /= xs.sum()
+            ys /= ys.sum()
+
+            # No action outside the supports may be a better response
+            ay = A @ ys
+            xb = xs @ B
+            if np.max(ay) <= np.max(ay[I[p]]) + tol and \
+                    np.max(xb) <= np.max(xb[J[p]]) + tol:
+                equilibria.append((xs, ys))
+    return equilibria
+
+def _indifference(sub, tol=1e-12):
+    """
+    Solves the stacked systems sub[p] z = v, sum(z) = 1 for z and v.
+    Returns the solutions z, with shape (P, k), and a mask of the systems
+    that are nonsingular.
+    """
+    P, k, _ = sub.shape
+    system = np.zeros((P, k+1, k+1))
+    system[:, :k, :k] = sub
+    system[:, :k, k] = -1.0
+    system[:, k, :k] = 1.0
+    rhs = np.zeros((P, k+1))
+    rhs[:, k] = 1.0
+
+    ok = np.abs(np.linalg.det(system)) > tol
+    z = np.zeros((P, k))
+    if np.any(ok):
+        z[ok] = np.linalg.solve(system[ok], rhs[ok][..., None])[:, :k, 0]
+    return z, ok
+
+def lemke_howson(game, label=0):
+    """
+    Returns a Nash equilibrium (x, y) of a two-player Game with the
+    Lemke-Howson algorithm, starting by dropping the given label. Labels
+    0, ..., m-1 are the row player's actions and m, ..., m+n-1 the column
+    player's. Ties in the ratio test are broken lexicographically, so the
+    algorithm also terminates on degenerate games.
+    """
+    A, B = _bimatrix(game)
+    m, n = A.shape
+    if not 0 <= label < m+n:
+        raise ValueError("Label must be an action of one of the players.")
+
+    # Make all payoffs positive, which does not change the equilibria
+    shift = 1 - min(A.min(), B.min(), 0)
+    A = A + shift
+    B = B + shift
+
+    # Row tableau: B^T x + s = 1, labels x = 0..m-1, s = m..m+n-1
+    # Column tableau: r + A y = 1, labels r = 0..m-1, y = m..m+n-1
+    row = np.hstack([B.T, np.eye(n), np.ones((n, 1))])
+    col = np.hstack([np.eye(m), A, np.ones((m, 1))])
+    tableaux = [ (row, list(range(m, m+n)), slice(m, m+n)),
+                 (col, list(range(m)), slice(0, m)) ]
+
+    current = 0 if label < m else 1
+    entering = label
+    while True:
+        leaving = _pivot(*tableaux[current], entering)
+        if leaving == label:
+            break
+        entering = leaving
+        current = 1 - current
+
+    x = _basic_values(row, tableaux[0][1], range(m))
+    y = _basic_values(col, tableaux[1][1], range(m, m+n))
+    return x / x.sum(), y / y.sum()
+
+def _pivot(tableau, basis, identity, entering):
+    """Pivots entering into the basis with the lexicographic minimum ratio
+    test and returns the label that leaves."""
+    column = tableau[:, entering]
+    candidates = np.flatnonzero(column > 1e-12)
+    if len(candidates) == 0:
+        raise ValueError("Unbounded pivot, the game may be degenerate.")
+    keys = np.hstack([ tableau[candidates, -1:],
+                        tableau[candidates, identity] ]) / \
+            column[candidates, None]
+    order = np.lexsort(keys.T[::-1])
+    r = candidates[order[0]]
+
+    tableau[r] /= tableau[r, entering]
+    for i in range(tableau.shape[0]):
+        if i != r:
+            tableau[i] -= tableau[i, entering] * tableau[r]
+
+    leaving = basis[r]
+    basis[r] = entering
+    return leaving
+
+def _basic_values(tableau, basis, labels):
+    values = np.zeros(len(labels))
+    for r, b in enumerate(basis):
+        if b in labels:
+            values[b - labels[0]] = tableau[r, -1]
+    return values
+
+#########
+# BATCH #
+#########
+
+def model_equilibria(model, method='pure'):
+    """
+    Returns the equilibria of the stage game in every state of a GCGMP, as
+    a list indexed by state.
+
+    For method 'pure', games of the same shape are stacked and solved
+    together, and each entry is an ndarray of joint actions as returned by
+    pure_equilibria. For the two-player methods 'support' and
+    'lemke-howson', each entry is the list returned by
+    support_enumeration, or the pair returned by lemke_howson.
+    """
+    games = model.games
+    if method == 'pure':
+        result = [ None ] * len(games)
+        shapes = {}
+        for state, g in enumerate(games):
+            shapes.setdefault(g.shape, []).append(state)
+        for states in shapes.values():
+            mask = pure_equilibrium_mask(np.stack([ games[s].mat
+                                                    for s in states ]))
+            found = np.argwhere(mask)
+            split = np.searchsorted(found[:, 0], np.arange(1, len(states)))
+            for s, eq in zip(states, np.split(found[:, 1:], split)):
+                result[s] = eq
+        return result
+    elif method == 'support':
+        return [ support_enumeration(g) for g in games ]
+    elif method == 'lemke-howson':
+        return [ lemke_howson(g) for g in games ]
+    else:
+        raise ValueError("Method must be pure, support or lemke-howson.")
+
+##################
+# ZERO-SUM GAMES #
+##################
+
+def solve_matrix_games(mats, supports=None, tol=1e-9):
+    """
+    Solves a stack of two-player zero-sum matrix games, in which the row
+    player receives the entries and the column player their negation.
+    Returns the values as an ndarray of shape (G,), optimal strategies of
+    the row and the column player as ndarrays of shape (G, m) and (G, n),
+    and the supports (rows, columns) of the solutions, one per game.
+
+    By the theorem of Shapley and Snow, every matrix game has optimal
+    strategies whose supports are of equal size and whose indifference
+    system is nonsingular. Supports of increasing size are tried for all
+    unsolved games together, as in support_enumeration.
+
+    Keyword arguments
+    mats -- an ndarray of shape (G, m, n)
+    supports -- supports to try first, one per game, such as those of a
+    previous call on similar games (default None)
+    tol -- the tolerance of the optimality check (default 1e-9)
+    """
+    mats = np.asarray(mats, dtype='float64')
+    G, m, n = mats.shape
+    values = np.zeros(G)
+    xs = np.zeros((G, m))
+    ys = np.zeros((G, n))
+    found = [ None ] * G
+
+    if supports is not None:
+        sizes = {}
+        for g, support in enumerate(supports):
+            if support is not None:
+                sizes.setdefault(len(support[0]), []).append(g)
+        for k, games in sizes.items():
+            games = np.array(games)
+            rows = np.array([ supports[g][0] for g in games ])[:, None]
+            cols = np.array([ supports[g][1] for g in games ])[:, None]
+            _solve_supports(mats, games, rows, cols, tol, values, xs, ys,
+                                found)
+
+    for k in range(1, min(m, n)+1):
+        games = np.array([ g for g in range(G) if found[g] is None ],
+                            dtype=np.intp)
+        if len(games) == 0:
+            break
+        rows = np.array(list(combinations(range(m), k)))
+        cols = np.array(list(combinations(range(n), k)))
+        pairs_r = np.repeat(rows, len(cols), axis=0)
+        pairs_c = np.tile(cols, (len(rows), 1))
+        _solve_supports(mats, games, np.broadcast_to(pairs_r, (len(games),)
+                            + pairs_r.shape), np.broadcast_to(pairs_c,
+                            (len(games),) + pairs_c.shape), tol, values, xs,
+                            ys, found)
+
+    if any(f is None for f in found):
+        raise ValueError("No optimal strategies found; the tolerance may be "
+            + "too small.")
+    return values, xs, ys, found
+
+def _solve_supports(mats, games, rows, cols, tol, values, xs, ys, found):
+    """
+    Tries the support pairs rows[g], cols[g] of shape (P, k) for each game
+    in games, and records the first pair giving optimal strategies.
+    """
+    G, P, k = rows.shape
+    m, n = mats.shape[1:]
+    sub = mats[games[:, None, None, None], rows[..., :, None],
+                cols[..., None, :]].reshape(G*P, k, k)
+    y, ok_y = _indifference(sub)
+    x, ok_x = _indifference(np.swapaxes(sub, 1, 2))
+    x = np.clip(x.reshape(G, P, k), 0, None)
+    y = np.clip(y.reshape(G, P, k), 0, None)
+    ok = (ok_x & ok_y).reshape(G, P) & (x.sum(axis=2) > 0) & \
+            (y.sum(axis=2) > 0)
+
+    full_x = np.zeros((G, P, m))
+    full_y = np.zeros((G, P, n))
+    np.put_along_axis(full_x, rows, x, axis=2)
+    np.put_along_axis(full_y, cols, y, axis=2)
+    full_x /= np.maximum(full_x.sum(axis=2, keepdims=True), 1e-300)
+    full_y /= np.maximum(full_y.sum(axis=2, keepdims=True), 1e-300)
+
+    # The row player guarantees at least low, the column player at most high
+    low = np.min(np.einsum('gpi,gij->gpj', full_x, mats[games]), axis=2)
+    high = np.max(np.einsum('gij,gpj->gpi', mats[games], full_y), axis=2)
+    ok &= high - low <= tol * max(1.0, np.max(np.abs(mats), initial=0.0))
+
+    for i, g in enumerate(games):
+        if found[g] is not None or not np.any(ok[i]):
+            continue
+        p = np.argmax(ok[i])
+        values[g] = (low[i, p] + high[i, p]) / 2
+        xs[g] = full_x[i, p]
+        ys[g] = full_y[i, p]
+        found[g] = (tuple(rows[i, p]), tuple(cols[i, p]))
+
+def value_iteration(model, discount=None, tol=1e-8, max_iter=100000,
+                        values=None, player=0, tau=0.5):
+    """
+    Solves a CGM with two players as a zero-sum game by value iteration, in
+    which one player maximizes and the other minimizes the stage payoffs of
+    the maximizer. Guards and configurations are not considered. Returns the
+    values, or the gains, of the states as an ndarray and a profile of
+    MixedStateBasedStrategy, one for each player, which are optimal in the
+    stage games of the last iteration.
+
+    With a discount factor, the value of a state is the discounted sum of
+    payoffs, and iteration stops when no value changes by more than tol.
+    Without one, the objective is the mean payoff: the values are iterated
+    undiscounted, shifted to keep them bounded, and the gain of each state
+    is its change per iteration; iteration stops when no gain changes by
+    more than tol. So that the values also converge in periodic models,
+    each iteration only moves them by a fraction tau of the update, which
+    makes every state keep its value with probability 1 - tau and leaves
+    the optimal strategies unchanged; the gain is the change divided by
+    tau. If the values have not converged after max_iter iterations, a
+    ValueError is raised.
+
+    In each iteration, the stage games of all states of the same shape are
+    solved together by solve_matrix_games, starting from the supports of
+    the previous iteration.
+
+    Keyword arguments
+    model -- a GuardedConcurrentGameModelPayoffs with two players
+    discount -- the discount factor in [0, 1), or None for the mean payoff
+    (default None)
+    tol -- the convergence tolerance (default 1e-8)
+    max_iter -- the largest number of iterations (default 100000)
+    values -- initial values, e.g. those of a previous solution (default
+    zeros)
+    player -- the maximizing player, whose payoffs are used (default 0)
+    tau -- the fraction of each update applied for the mean payoff, in
+    (0, 1] (default 0.5)
+    """
+    if model.players != 2:
+        raise ValueError("Model must have two players.")
+    if discount is not None and not 0 <= discount < 1:
+        raise ValueError("Discount factor must be in [0, 1).")
+    if not 0 < tau <= 1:
+        raise ValueError("Fraction tau must be in (0, 1].")
+
+    states = len(model.states)
+    groups = {}
+    for state in range(states):
+        groups.setdefault(np.shape(model.transitions[state]), []).append(
+                            state)
+    stages = []
+    for shape, members in groups.items():
+        members = np.array(members)
+        targets = np.stack([ np.asarray(model.transitions[s])
+                                for s in members ])
+        rewards = np.stack([ model.games[s].mat[..., player]
+                                for s in members ])
+        if player == 1:
+            targets = np.swapaxes(targets, 1, 2)
+            rewards = np.swapaxes(rewards, 1, 2)
+        stages.append((members, targets, rewards))
+
+    V = np.zeros(states) if values is None else \
+            np.array(values, dtype='float64')
+    gamma = 1.0 if discount is None else discount
+    supports = [ None ] * states
+    x = [ None ] * states
+    y = [ None ] * states
+    gain = np.zeros(states)
+
+    done = False
+    for _ in range(max_iter):
+        W = np.empty(states)
+        for members, targets, rewards in stages:
+            result, xs, ys, found = solve_matrix_games(
+                    rewards + gamma * V[targets],
+                    [ supports[s] for s in members ], tol)
+            W[members] = result
+            for i, s in enumerate(members):
+                supports[s] = found[i]
+                x[s] = xs[i]
+                y[s] = ys[i]
+
+        if discount is not None:
+            done = np.max(np.abs(W - V), initial=0.0) <= tol
+            V = W
+        else:
+            change = W - V
+            done = np.max(np.abs(change - gain), initial=0.0) <= tol
+            gain = change
+            V = V + tau*change
+            V -= V.max()
+        if done:
+            break
+    if not done:
+        raise ValueError("Value iteration did not converge within max_iter "
+            + "iterations.")
+
+    if player == 1:
+        x, y = y, x
+    profile = [ MixedStateBasedStrategy([ MixedStrategy(d) for d in x ]),
+                MixedStateBasedStrategy([ MixedStrategy(d) for d in y ]) ]
+    return (V if discount is not None else gain), profile
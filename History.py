@@ -0,0 +1,300 @@
+"""
+History - A module for recording plays of games, using numpy.
+"""
+
+import os
+import numpy as np
+from collections import deque
+
+class PlayHistory:
+    """
+    The history of a play, stored in typed ndarrays: the state and joint
+    move of each step and, for models with payoffs, the payoff and the
+    configuration after the step.
+
+    Without a window, the arrays grow by doubling. With a window of K steps,
+    they are ring buffers keeping only the last K steps. Aggregates of the
+    payoffs and configurations are maintained incrementally at each step:
+    the sum, minimum and maximum over the whole play and the sum, minimum
+    and maximum over the window. Window extrema are kept with monotonic
+    queues, so that each step costs amortized constant time. Without a
+    window, the window aggregates are those of the whole play.
+    """
+    def __init__(self, players, window=None, capacity=1024, configs=False,
+                    state_dtype='int32', move_dtype='int16', sink=None):
+        """
+        Initialize an empty history.
+
+        Keyword arguments
+        players -- the number of players
+        window -- the number of steps kept, or None to keep all (default None)
+        capacity -- the initial capacity when all steps are kept
+        (default 1024)
+        configs -- whether to store the configuration of each step; their
+        aggregates are maintained either way (default False)
+        state_dtype -- the dtype of stored states (default int32)
+        move_dtype -- the dtype of stored moves (default int16)
+        sink -- a TrajectoryWriter receiving every step (default None)
+        """
+        self.players = players
+        self.window = window
+        self.keep_configs = configs
+        self.state_dtype = state_dtype
+        self.move_dtype = move_dtype
+        self.capacity = window if window is not None else max(capacity, 1)
+        self.sink = sink
+        self.clear()
+
+    def clear(self):
+        """Empties the history and resets all aggregates."""
+        n = self.capacity
+        self._states = np.zeros(n, dtype=self.state_dtype)
+        self._moves = np.zeros((n, self.players), dtype=self.move_dtype)
+        self._payoffs = np.zeros((n, self.players))
+        self._configs = np.zeros((n, self.players)) if self.keep_configs \
+                            else None
+        self.steps = 0
+        self.start = 0
+        self.length = 0
+
+        self.total = np.zeros(self.players)
+        self.payoff_min = np.full(self.players, np.inf)
+        self.payoff_max = np.full(self.players, -np.inf)
+        self.config_min = np.full(self.players, np.inf)
+        self.config_max = np.full(self.players, -np.inf)
+        self.window_total = np.zeros(self.players)
+        self._queues = { key : [ deque() for _ in range(self.players) ]
+                            for key in ('pmin', 'pmax', 'cmin', 'cmax') }
+
+    def __len__(self):
+        return self.length
+
+    def append(self, state, move, payoff=None, config=None):
+        """Records one step."""
+        if self.sink is not None:
+            self.sink.append(state, move, payoff, config)
+        if self.window is None and self.length == len(self._states):
+            self._grow()
+
+        i = (self.start + self.length) % len(self._states)
+        if self.window is not None and self.length == self.window:
+            if payoff is not None:
+                self.window_total -= self._payoffs[i]
+            self.start = (self.start + 1) % len(self._states)
+        else:
+            self.length += 1
+
+        self._states[i] = state
+        self._moves[i] = move
+        if payoff is not None:
+            self._payoffs[i] = payoff
+            self.total += payoff
+            self.window_total += payoff
+            np.minimum(self.payoff_min, payoff, out=self.payoff_min)
+            np.maximum(self.payoff_max, payoff, out=self.payoff_max)
+            if self.window is not None:
+                self._push('pmin', payoff, np.less_equal)
+                self._push('pmax', payoff, np.greater_equal)
+        if config is not None:
+            if self._configs is not None:
+                self._configs[i] = config
+            np.minimum(self.config_min, config, out=self.config_min)
+            np.maximum(self.config_max, config, out=self.config_max)
+            if self.window is not None:
+                self._push('cmin', config, np.less_equal)
+                self._push('cmax', config, np.greater_equal)
+        self.steps += 1
+
+    def _push(self, key, values, keep):
+        """Adds the values of a step to the monotonic queues of key, where
+        keep(a, b) holds if a new value a makes an older value b obsolete."""
+        first = self.steps - self.length + 1
+        for queue, v in zip(self._queues[key], values):
+            while queue and keep(v, queue[-1][1]):
+                queue.pop()
+            queue.append((self.steps, v))
+            while queue[0][0] < first:
+                queue.popleft()
+
+    def _grow(self):
+        n = len(self._states)
+        self._states = np.concatenate([self._states, np.zeros_like(
+                                                        self._states)])
+        self._moves = np.concatenate([self._moves, np.zeros_like(self._moves)])
+        self._payoffs = np.concatenate([self._payoffs, np.zeros((n,
+                                                        self.players))])
+        if self._configs is not None:
+            self._configs = np.concatenate([self._configs, np.zeros((n,
+                                                        self.players))])
+
+    def _ordered(self, array):
+        """Returns the stored steps of an array in chronological order."""
+        if self.start == 0:
+            return array[:self.length]
+        return array[(self.start + np.arange(self.length)) % len(array)]
+
+    def states(self):
+        """Returns the stored states, oldest first."""
+        return self._ordered(self._states)
+
+    def moves(self):
+        """Returns the stored joint moves, as an ndarray of shape
+        (steps, players)."""
+        return self._ordered(self._moves)
+
+    def payoffs(self):
+        """Returns the stored payoffs, as an ndarray of shape
+        (steps, players)."""
+        return self._ordered(self._payoffs)
+
+    def configs(self):
+        """Returns the stored configurations, if they are kept."""
+        if self._configs is None:
+            raise ValueError("Configurations are not kept.")
+        return self._ordered(self._configs)
+
+    def mean(self):
+        """Returns the mean payoff over the whole play."""
+        return self.total / max(self.steps, 1)
+
+    def window_mean(self):
+        """Returns the mean payoff over the stored steps."""
+        return self.window_total / max(self.length, 1)
+
+    def window_min(self, config=False):
+        """Returns the minimal payoff, or configuration, over the stored
+        steps."""
+        return self._extreme('cmin' if config else 'pmin', np.inf)
+
+    def window_max(self, config=False):
+        """Returns the maximal payoff, or configuration, over the stored
+        steps."""
+        return self._extreme('cmax' if config else 'pmax', -np.inf)
+
+    def _extreme(self, key, empty):
+        if self.window is None:
+            return { 'pmin' : self.payoff_min, 'pmax' : self.payoff_max,
+                     'cmin' : self.config_min, 'cmax' : self.config_max }[key]
+        return np.array([ q[0][1] if q else empty for q in self._queues[key] ])
+
+    def __str__(self):
+        return str([ (int(s), tuple(int(a) for a in m))
+                        for s, m in zip(self.states(), self.moves()) ])
+
+class TrajectoryWriter:
+    """
+    Streams the steps of a play to an append-only file. Steps are buffered
+    in preallocated arrays and written in chunks of a fixed number of steps,
+    each chunk as consecutive .npy arrays of states, moves and, if kept,
+    payoffs and configurations. The file starts with a small header array
+    of the version, the number of players, whether payoffs are kept and the
+    dtypes of states and moves.
+    Memory use is bounded by the chunk size, and the file is written
+    sequentially. Use read_trajectory to iterate over the chunks.
+    """
+    version = 1
+
+    def __init__(self, path, players, chunk=65536, payoffs=True,
+                    state_dtype='int32', move_dtype='int16'):
+        """
+        Keyword arguments
+        path -- the file to write; an existing file is appended to, and must
+        have the same players and payoffs, and its dtypes are used
+        players -- the number of players
+        chunk -- the number of steps per chunk (default 65536)
+        payoffs -- whether payoffs and configurations are recorded
+        (default True)
+        state_dtype -- the dtype of states (default int32)
+        move_dtype -- the dtype of moves (default int16)
+        """
+        self.players = players
+        self.payoffs = payoffs
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                header = _read_header(f)
+            if header[:2] != (players, payoffs):
+                raise ValueError("Trajectory in file has other players or "
+                    + "payoffs.")
+            state_dtype, move_dtype = header[2:]
+
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            np.save(self.file, np.array([ str(self.version), str(players),
+                                str(int(payoffs)), np.dtype(state_dtype).str,
+                                np.dtype(move_dtype).str ]))
+        self.steps = 0
+        self.length = 0
+
+        self._states = np.zeros(chunk, dtype=state_dtype)
+        self._moves = np.zeros((chunk, players), dtype=move_dtype)
+        if payoffs:
+            self._payoffs = np.zeros((chunk, players))
+            self._configs = np.zeros((chunk, players))
+
+    def append(self, state, move, payoff=None, config=None):
+        """Buffers one step, writing a chunk when the buffer is full."""
+        i = self.length
+        self._states[i] = state
+        self._moves[i] = move
+        if self.payoffs:
+            self._payoffs[i] = payoff
+            self._configs[i] = config
+        self.length += 1
+        self.steps += 1
+        if self.length == len(self._states):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered steps as a chunk."""
+        if self.length == 0:
+            return
+        n = self.length
+        np.save(self.file, self._states[:n])
+        np.save(self.file, self._moves[:n])
+        if self.payoffs:
+            np.save(self.file, self._payoffs[:n])
+            np.save(self.file, self._configs[:n])
+        self.length = 0
+
+    def clear(self):
+        """Writes the buffered steps. A trajectory on file is never
+        removed."""
+        self.flush()
+
+    def close(self):
+        """Writes the buffered steps and closes the file."""
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_trajectory(path):
+    """
+    Iterates over the chunks of a file written by a TrajectoryWriter, one
+    chunk at a time. Each chunk is a tuple (states, moves, payoffs,
+    configs), where payoffs and configs are None if they were not recorded.
+    """
+    with open(path, 'rb') as f:
+        players, payoffs = _read_header(f)[:2]
+        end = os.fstat(f.fileno()).st_size
+        while f.tell() < end:
+            states = np.load(f)
+            moves = np.load(f)
+            if payoffs:
+                yield states, moves, np.load(f), np.load(f)
+            else:
+                yield states, moves, None, None
+
+def _read_header(f):
+    """Reads the header of a trajectory file, returning the number of
+    players, whether payoffs are kept and the dtypes of states and
+    moves."""
+    header = np.load(f)
+    if len(header) != 5 or int(header[0]) != TrajectoryWriter.version:
+        raise ValueError("Unsupported trajectory format version.")
+    return int(header[1]), bool(int(header[2])), np.dtype(header[3]), \
+                np.dtype(header[4])
@@ -1,6 +1,5 @@
-import intervals as I
 import numpy as np
-from Strategy import Segmentation
+from Strategy import Segmentation, IntervalSet
 
 class Parser:
 
@@ -100,13 +99,13 @@ class IntervalParser(Parser):
             raise ValueError('Unexpected character, expected ) or ].')
 
         if left+right == '[]':
-            return I.closed(lower,upper)
+            return IntervalSet.closed(lower,upper)
         elif left+right == '[)':
-            return I.closedopen(lower,upper)
+            return IntervalSet.closedopen(lower,upper)
         elif left+right == '(]':
-            return I.openclosed(lower,upper)
+            return IntervalSet.openclosed(lower,upper)
         elif left+right == '()':
-            return I.open(lower,upper)
+            return IntervalSet.open(lower,upper)
 
     def parseFloat(self):
         num = ''
@@ -2,6 +2,7 @@
 PresburgerArithmetic - A module for Presburger Arithmetic
 """
 
+import heapq
 import numpy as np
 
 class LinearConstraint():
@@ -11,7 +12,7 @@ class LinearConstraint():
     def __init__(self,A,lb,ub):
         self.A = np.array(A)
         if (lb > ub):
-            raise ArgumentError("Lower bound must be smaller than upper bound.")
+            raise ValueError("Lower bound must be smaller than upper bound.")
         self.lb = lb
         self.ub = ub
 
@@ -23,7 +24,7 @@ class PAFormula():
     """
     A formula in Presburger Arithmetic (PA), i.e a Boolean combination of
     linear constraint. All linear constraints are assumed to be over the
-    same variables.
+    same variables. The operators & and | take two or more subformulas.
     """
     def __init__(self, attr = True, children=None):
 
@@ -55,8 +56,9 @@ class PAFormula():
 
             # Check that the number of children is equal to the arity
             # of the logical operator
-            if (attr == '&' or attr == '|') and len(children) != 2:
-                raise TypeError("Operators & and | are binary.")
+            if (attr == '&' or attr == '|') and len(children) < 2:
+                raise TypeError("Operators & and | take at least two " +
+                                    "subformulas.")
             if (attr == '~') and len(children) != 1:
                 raise TypeError("Operator ~ is unary.")
             if (attr is True or attr is False) and children != None:
@@ -85,12 +87,582 @@ class PAFormula():
 
     def __call__(self,x):
         if self.attr == '&':
-            return self.children[0](x) and self.children[1](x)
+            return all(ch(x) for ch in self.children)
         elif self.attr == '|':
-            return self.children[0](x) or self.children[1](x)
+            return any(ch(x) for ch in self.children)
         elif self.attr == '~':
             return not self.children[0](x)
         elif type(self.attr) == LinearConstraint:
             return self.attr(x)
         else:
             return self.attr
+
+    def simplify(self, integral=False, samples=None):
+        """ Returns a simplified, equivalent formula. See simplify """
+        return simplify(self, integral, samples)
+
+    def compile(self):
+        """ Returns a CompiledFormula evaluating this formula over batches
+        of configurations """
+        return CompiledFormula(self)
+
+    def classify(self, lower, upper, integral=False):
+        """ Returns True, False or None if the formula holds everywhere,
+        nowhere or somewhere within the bounds. See classify """
+        return classify(self, lower, upper, integral)
+
+class CompiledFormula():
+    """
+    A PAFormula compiled for vectorized evaluation. The linear constraints
+    of the formula are stacked into a coefficient matrix A with bound
+    vectors lb and ub, so that all constraints are evaluated by a single
+    matrix product. The Boolean structure is kept as a tree of nested tuples
+    whose leaves are row indices of A.
+    """
+    def __init__(self, formula):
+        self.constraints = []
+        self._rows = {}
+        self.tree = self._build(PAFormula(formula))
+
+        if self.constraints:
+            self.A = np.array([ c.A for c in self.constraints ],
+                                dtype='float64')
+        else:
+            self.A = np.zeros((0, 0))
+        self.lb = np.array([ c.lb for c in self.constraints ],
+                            dtype='float64')
+        self.ub = np.array([ c.ub for c in self.constraints ],
+                            dtype='float64')
+
+    def _build(self, formula):
+        """ Translates a PAFormula into a tuple tree, registering each
+        distinct LinearConstraint as one row """
+        if type(formula.attr) == LinearConstraint:
+            key = id(formula.attr)
+            if key not in self._rows:
+                self._rows[key] = len(self.constraints)
+                self.constraints.append(formula.attr)
+            return ('c', self._rows[key])
+        elif formula.children is None:
+            return ('t', bool(formula.attr))
+        else:
+            return (formula.attr,) + tuple(self._build(ch)
+                                            for ch in formula.children)
+
+    def constraint_values(self, X):
+        """ Returns the truth values of all constraints for a batch X of
+        configurations, as a boolean ndarray of shape (M, constraints) """
+        V = np.asarray(X, dtype='float64') @ self.A.T
+        return (V >= self.lb) & (V <= self.ub)
+
+    def evaluate(self, T, node=None):
+        """ Combines constraint truth values T of shape (M, constraints)
+        following the formula, returning a boolean ndarray of shape (M,) """
+        if node is None:
+            node = self.tree
+        op = node[0]
+        if op == 'c':
+            return T[:, node[1]]
+        elif op == 't':
+            return np.full(T.shape[0], node[1])
+        elif op == '~':
+            return ~self.evaluate(T, node[1])
+        elif op == '&':
+            result = self.evaluate(T, node[1])
+            for child in node[2:]:
+                result = result & self.evaluate(T, child)
+            return result
+        else:
+            result = self.evaluate(T, node[1])
+            for child in node[2:]:
+                result = result | self.evaluate(T, child)
+            return result
+
+    def __call__(self, X):
+        """ Evaluates the formula at a configuration, or at each row of a
+        batch of configurations of shape (M, players) """
+        X = np.asarray(X, dtype='float64')
+        if X.ndim == 1:
+            return bool(self(X[None, :])[0])
+        if not self.constraints:
+            return self.evaluate(np.zeros((X.shape[0], 0), dtype=bool))
+        return self.evaluate(self.constraint_values(X))
+
+
+class IncrementalEvaluator():
+    """
+    Tracks the truth values of a collection of formulas along a play, in
+    which the configuration changes by a payoff vector at each step.
+
+    For each distinct linear constraint, the value of A.x is stored with its
+    distance to the nearest bound at which its truth value flips. Since
+    |A.d| <= |A|_1 * |d|_inf for a step d, a constraint cannot flip before
+    the accumulated sup-norm drift of the configuration has reached that
+    distance divided by |A|_1. Constraints are kept in a heap ordered by this
+    deadline, and only those whose deadline has passed are recomputed. A
+    formula is re-evaluated only when one of its constraints has flipped.
+    """
+    def __init__(self, formulas, x):
+        """
+        Keyword arguments
+        formulas -- a list of PAFormula or LinearConstraint objects
+        x -- the initial configuration
+        """
+        self.constraints = []
+        rows = {}
+        self.trees = []
+        self.dependents = []
+        for j, formula in enumerate(formulas):
+            compiled = CompiledFormula(formula)
+            mapping = []
+            for c in compiled.constraints:
+                if id(c) not in rows:
+                    rows[id(c)] = len(self.constraints)
+                    self.constraints.append(c)
+                    self.dependents.append([])
+                self.dependents[rows[id(c)]].append(j)
+                mapping.append(rows[id(c)])
+            self.trees.append(_remap(compiled.tree, mapping))
+
+        n = len(np.atleast_1d(x))
+        self.A = np.array([ c.A for c in self.constraints ],
+                            dtype='float64').reshape(-1, n)
+        self.lb = np.array([ c.lb for c in self.constraints ],
+                            dtype='float64')
+        self.ub = np.array([ c.ub for c in self.constraints ],
+                            dtype='float64')
+        self.norms = np.sum(np.abs(self.A), axis=1)
+        self.reset(x)
+
+    def reset(self, x):
+        """ Recomputes everything at configuration x """
+        self.x = np.array(x, dtype='float64')
+        self.drift = 0.0
+        self.values = self.A @ self.x
+        self.truth = (self.values >= self.lb) & (self.values <= self.ub)
+        self.heap = []
+        for i in range(len(self.constraints)):
+            self._schedule(i)
+        heapq.heapify(self.heap)
+        self.results = np.array([ _evaluate_node(t, self.truth)
+                                    for t in self.trees ], dtype=bool)
+
+    def _schedule(self, i, push=False):
+        """ Registers the deadline of constraint i """
+        if self.norms[i] == 0:
+            return
+        v = self.values[i]
+        if self.truth[i]:
+            margin = min(v - self.lb[i], self.ub[i] - v)
+        else:
+            margin = self.lb[i] - v if v < self.lb[i] else v - self.ub[i]
+        # Shrink the deadline slightly against rounding in the drift.
+        entry = (self.drift + margin / self.norms[i] * (1 - 1e-9), i)
+        if push:
+            heapq.heappush(self.heap, entry)
+        else:
+            self.heap.append(entry)
+
+    def update(self, delta):
+        """ Moves the configuration by delta and returns the truth values of
+        all formulas as a boolean ndarray """
+        delta = np.asarray(delta, dtype='float64')
+        self.x += delta
+        self.drift += np.max(np.abs(delta), initial=0.0)
+
+        dirty = set()
+        while self.heap and self.heap[0][0] < self.drift:
+            i = heapq.heappop(self.heap)[1]
+            self.values[i] = self.A[i] @ self.x
+            truth = self.lb[i] <= self.values[i] <= self.ub[i]
+            if truth != self.truth[i]:
+                self.truth[i] = truth
+                dirty.update(self.dependents[i])
+            self._schedule(i, push=True)
+
+        for j in dirty:
+            self.results[j] = _evaluate_node(self.trees[j], self.truth)
+        return self.results
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+def _remap(node, mapping):
+    """ Renumbers the constraint leaves of a CompiledFormula tree """
+    if node[0] == 'c':
+        return ('c', mapping[node[1]])
+    elif node[0] == 't':
+        return node
+    return (node[0],) + tuple(_remap(ch, mapping) for ch in node[1:])
+
+def _evaluate_node(node, truth):
+    """ Evaluates a CompiledFormula tree for a single truth vector """
+    op = node[0]
+    if op == 'c':
+        return bool(truth[node[1]])
+    elif op == 't':
+        return node[1]
+    elif op == '~':
+        return not _evaluate_node(node[1], truth)
+    elif op == '&':
+        return all(_evaluate_node(ch, truth) for ch in node[1:])
+    else:
+        return any(_evaluate_node(ch, truth) for ch in node[1:])
+
+##################
+# SIMPLIFICATION #
+##################
+
+def simplify(formula, integral=False, samples=None):
+    """
+    Returns a formula equivalent to the given one, which is cheaper to
+    evaluate. Constants are folded, negations are pushed down to the
+    constraints, nested conjunctions and disjunctions are flattened into
+    n-ary nodes, constraints over the same coefficient vector are merged,
+    and the children of each node are reordered so that cheap and decisive
+    subformulas are evaluated first.
+
+    Keyword arguments
+    formula -- a PAFormula or LinearConstraint
+    integral -- whether A.x is integral for all configurations. Negated
+        constraints are then replaced by bounds and adjacent intervals
+        are merged (default False)
+    samples -- an ndarray of configurations of shape (M, players), used to
+        measure how often each subformula holds (default None, in which
+        case children are ordered by cost alone)
+    """
+    formula = _normalize(PAFormula(formula), False, integral)
+    if samples is not None:
+        samples = np.asarray(samples, dtype='float64')
+    return _reorder(formula, samples)[0]
+
+def _constant(value):
+    return PAFormula(bool(value))
+
+def _normalize(formula, negate, integral):
+    """ Pushes negation down and simplifies each node bottom-up """
+    if type(formula.attr) == LinearConstraint:
+        c = formula.attr
+        if not negate:
+            if c.lb == -np.inf and c.ub == np.inf:
+                return _constant(True)
+            return PAFormula(c)
+        if c.lb == -np.inf and c.ub == np.inf:
+            return _constant(False)
+        if not integral:
+            return PAFormula('~', [c])
+        parts = []
+        if c.lb > -np.inf:
+            parts.append(PAFormula(LinearConstraint(c.A, -np.inf,
+                                                    np.ceil(c.lb)-1)))
+        if c.ub < np.inf:
+            parts.append(PAFormula(LinearConstraint(c.A, np.floor(c.ub)+1,
+                                                    np.inf)))
+        return _combine('|', parts, integral)
+    elif formula.children is None:
+        return _constant(bool(formula.attr) != negate)
+    elif formula.attr == '~':
+        return _normalize(formula.children[0], not negate, integral)
+
+    op = formula.attr
+    if negate:
+        op = '|' if op == '&' else '&'
+    return _combine(op, [ _normalize(ch, negate, integral)
+                            for ch in formula.children ], integral)
+
+def _combine(op, children, integral):
+    """ Builds an n-ary node, flattening, folding constants and merging
+    constraints over the same coefficient vector """
+    absorbing = (op == '|')
+    flat = []
+    for ch in children:
+        if ch.attr == op:
+            flat.extend(ch.children)
+        else:
+            flat.append(ch)
+
+    rest = []
+    groups = {}
+    for ch in flat:
+        if ch.children is None and type(ch.attr) != LinearConstraint:
+            if bool(ch.attr) == absorbing:
+                return _constant(absorbing)
+        elif type(ch.attr) == LinearConstraint:
+            key = (ch.attr.A.shape, tuple(ch.attr.A.ravel()))
+            groups.setdefault(key, []).append(ch.attr)
+        else:
+            rest.append(ch)
+
+    merged = []
+    for constraints in groups.values():
+        A = constraints[0].A
+        if op == '&':
+            lb = max(c.lb for c in constraints)
+            ub = min(c.ub for c in constraints)
+            if lb > ub:
+                return _constant(False)
+            merged.append(PAFormula(LinearConstraint(A, lb, ub)))
+            continue
+
+        gap = 1 if integral else 0
+        bounds = [ (c.lb, c.ub) for c in constraints ]
+        if integral:
+            # A.x is integral, so only the integers of each range count
+            bounds = [ (np.ceil(l), np.floor(u)) for l, u in bounds ]
+            bounds = [ (l, u) for l, u in bounds if l <= u ]
+            if not bounds:
+                continue
+        bounds = sorted(bounds)
+        lb, ub = bounds[0]
+        for l, u in bounds[1:]:
+            if l <= ub + gap:
+                ub = max(ub, u)
+            else:
+                merged.append(PAFormula(LinearConstraint(A, lb, ub)))
+                lb, ub = l, u
+        if lb == -np.inf and ub == np.inf:
+            return _constant(True)
+        merged.append(PAFormula(LinearConstraint(A, lb, ub)))
+
+    children = merged + rest
+    if len(children) == 0:
+        return _constant(not absorbing)
+    if len(children) == 1:
+        return children[0]
+    return PAFormula(op, children)
+
+def _reorder(formula, samples):
+    """ Reorders children bottom-up. Returns the reordered formula, its cost
+    in constraint evaluations and its truth values on samples (or None) """
+    if type(formula.attr) == LinearConstraint:
+        truth = None
+        if samples is not None:
+            v = samples @ formula.attr.A
+            truth = (v >= formula.attr.lb) & (v <= formula.attr.ub)
+        return formula, 1, truth
+    elif formula.children is None:
+        truth = None
+        if samples is not None:
+            truth = np.full(len(samples), bool(formula.attr))
+        return formula, 0, truth
+
+    results = [ _reorder(ch, samples) for ch in formula.children ]
+    cost = sum(r[1] for r in results)
+
+    if formula.attr == '~':
+        truth = None if samples is None else ~results[0][2]
+        return PAFormula('~', [results[0][0]]), cost, truth
+
+    # A child decides a conjunction when it is false and a disjunction when
+    # it is true, so order by expected cost per decision.
+    def key(r):
+        p = 0.5 if samples is None or len(samples) == 0 else np.mean(r[2])
+        hit = 1 - p if formula.attr == '&' else p
+        return r[1] / hit if hit > 0 else np.inf
+    results.sort(key=key)
+
+    truth = None
+    if samples is not None:
+        truth = results[0][2]
+        for r in results[1:]:
+            truth = truth & r[2] if formula.attr == '&' else truth | r[2]
+    return PAFormula(formula.attr, [ r[0] for r in results ]), cost, truth
+
+##################
+# SATISFIABILITY #
+##################
+
+def refine(formula, lo, hi):
+    """
+    Returns a box (lo, hi) containing every configuration of the box
+    (lo, hi) which satisfies formula, or None if there is none. Constraints
+    are propagated interval-wise, so the box may be larger than necessary,
+    but None is only returned if the formula is unsatisfiable in the box.
+
+    Keyword arguments
+    formula -- a PAFormula or LinearConstraint
+    lo -- the lower bounds of the box, an ndarray of shape (players,)
+    hi -- the upper bounds of the box
+    """
+    return _refine(simplify(formula), np.array(lo, dtype='float64'),
+                        np.array(hi, dtype='float64'))
+
+def classify(formula, lower, upper, integral=False, budget=1000):
+    """
+    Decides whether a formula holds for all configurations within the
+    bounds, for none of them, or for some but not all. Returns True, False
+    or None respectively. None is also returned when the search budget is
+    exhausted, so True and False are always proven.
+
+    Each subformula is first evaluated on the whole box in three-valued
+    logic, with A.x ranging over an interval. If that does not decide it,
+    the formula and its negation are each searched for a satisfying
+    configuration by branch and bound: boxes are narrowed by refine,
+    discarded when the formula is false on all of them, accepted when it is
+    true on all of them or at their center, and otherwise bisected along
+    their widest coordinate.
+
+    Keyword arguments
+    formula -- a PAFormula or LinearConstraint
+    lower -- the lowest value of each coordinate
+    upper -- the highest value of each coordinate
+    integral -- whether only integer configurations are considered
+        (default False)
+    budget -- the largest number of boxes examined by each search
+        (default 1000)
+    """
+    # Negations are replaced by integer bounds only if A.x is integral
+    exact = integral and all(np.all(c.A == np.round(c.A))
+                            for c in CompiledFormula(formula).constraints)
+    formula = simplify(formula, exact)
+    lower = np.array(lower, dtype='float64')
+    upper = np.array(upper, dtype='float64')
+    if integral:
+        lower = np.ceil(lower)
+        upper = np.floor(upper)
+    if np.any(lower > upper):
+        raise ValueError("Bounds must contain a configuration.")
+
+    value = _truth(formula, lower, upper)
+    if value is not None:
+        return value
+    negation = simplify(PAFormula('~', [formula]), exact)
+    if _satisfiable(formula, lower, upper, integral, budget) is False:
+        return False
+    if _satisfiable(negation, lower, upper, integral, budget) is False:
+        return True
+    return None
+
+def _truth(formula, lo, hi):
+    """ Evaluates a simplified formula on the box (lo, hi) in three-valued
+    logic: True or False if it has that value on the whole box, else None """
+    attr = formula.attr
+    if type(attr) == LinearConstraint:
+        low, high = _range(attr.A, lo, hi)
+        if low >= attr.lb and high <= attr.ub:
+            return True
+        if high < attr.lb or low > attr.ub:
+            return False
+        return None
+    elif formula.children is None:
+        return bool(attr)
+    values = [ _truth(ch, lo, hi) for ch in formula.children ]
+    if attr == '~':
+        return None if values[0] is None else not values[0]
+    decisive = (attr == '|')
+    if decisive in values:
+        return decisive
+    if None in values:
+        return None
+    return not decisive
+
+def _satisfiable(formula, lo, hi, integral, budget):
+    """ Searches the box (lo, hi) for a configuration satisfying a
+    simplified formula. Returns True if one is found, False if there is
+    none, and None if the budget runs out """
+    boxes = [ (lo, hi) ]
+    while boxes:
+        if budget == 0:
+            return None
+        budget -= 1
+        box = _refine(formula, *boxes.pop())
+        if box is None:
+            continue
+        lo, hi = box
+        if integral:
+            lo = np.ceil(lo - 1e-9)
+            hi = np.floor(hi + 1e-9)
+            if np.any(lo > hi):
+                continue
+        value = _truth(formula, lo, hi)
+        if value is False:
+            continue
+        center = _center(lo, hi, integral)
+        if value is True or formula(center):
+            return True
+        if np.all(lo == hi):
+            continue
+
+        # Bisect the widest coordinate
+        j = np.argmax(hi - lo)
+        mid = center[j]
+        left = hi.copy()
+        right = lo.copy()
+        left[j] = mid
+        right[j] = mid + 1 if integral else mid
+        boxes.append((lo, left))
+        boxes.append((right, hi))
+    return False
+
+def _center(lo, hi, integral):
+    """ Returns a point strictly inside the box (lo, hi) along coordinates
+    of positive width, rounded down if integral """
+    with np.errstate(invalid='ignore'):
+        center = np.where(np.isfinite(lo) & np.isfinite(hi), (lo + hi) / 2,
+                    np.where(np.isfinite(lo), lo + np.maximum(1, np.abs(lo)),
+                    np.where(np.isfinite(hi), hi - np.maximum(1, np.abs(hi)),
+                        0.0)))
+    return np.floor(center) if integral else center
+
+def _range(A, lo, hi):
+    """ Returns the range of A.x over the box (lo, hi) """
+    A = np.asarray(A, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        low = np.where(A == 0, 0.0, np.minimum(A*lo, A*hi))
+        high = np.where(A == 0, 0.0, np.maximum(A*lo, A*hi))
+    return low.sum(), high.sum()
+
+def _refine(formula, lo, hi):
+    attr = formula.attr
+    if type(attr) == LinearConstraint:
+        return _revise(attr.A, attr.lb, attr.ub, lo, hi)
+    elif formula.children is None:
+        return (lo, hi) if attr else None
+    elif attr == '~':
+        # After simplification, only constraints are negated. The closure
+        # of the complement of a constraint is one or two half-spaces.
+        c = formula.children[0].attr
+        parts = []
+        if c.lb > -np.inf:
+            parts.append(_revise(c.A, -np.inf, c.lb, lo, hi))
+        if c.ub < np.inf:
+            parts.append(_revise(c.A, c.ub, np.inf, lo, hi))
+        return _hull(parts)
+    elif attr == '&':
+        box = (lo, hi)
+        for ch in formula.children:
+            box = _refine(ch, *box)
+            if box is None:
+                return None
+        return box
+    return _hull([ _refine(ch, lo, hi) for ch in formula.children ])
+
+def _revise(A, lb, ub, lo, hi):
+    """ Narrows the box (lo, hi) to lb <= A.x <= ub, one coordinate at a
+    time """
+    A = np.asarray(A, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        low = np.where(A == 0, 0.0, np.minimum(A*lo, A*hi))
+        high = np.where(A == 0, 0.0, np.maximum(A*lo, A*hi))
+    if low.sum() > ub or high.sum() < lb:
+        return None
+
+    lo = lo.copy()
+    hi = hi.copy()
+    for j in np.flatnonzero(A):
+        rest_low = np.delete(low, j).sum()
+        rest_high = np.delete(high, j).sum()
+        with np.errstate(invalid='ignore'):
+            a, b = np.array([ lb - rest_high, ub - rest_low ]) / A[j]
+        lo[j] = np.fmax(lo[j], np.fmin(a, b))
+        hi[j] = np.fmin(hi[j], np.fmax(a, b))
+        if lo[j] > hi[j]:
+            return None
+    return lo, hi
+
+def _hull(boxes):
+    boxes = [ b for b in boxes if b is not None ]
+    if not boxes:
+        return None
+    return np.min([ b[0] for b in boxes ], axis=0), \
+            np.max([ b[1] for b in boxes ], axis=0)
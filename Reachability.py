@@ -0,0 +1,317 @@
+"""
+Reachability - A module for reachability analysis of games, using numpy.
+"""
+
+import numpy as np
+from PresburgerArithmetic import refine, classify
+
+###########
+# KEY SET #
+###########
+
+class KeySet:
+    """
+    A set of nonnegative integer keys, stored in an open-addressing hash
+    table of int64 with linear probing. Keys are inserted in batches, and
+    all keys of a batch probe the table together.
+    """
+    def __init__(self, capacity=1024):
+        size = 1 << max(int(capacity)*2 - 1, 1).bit_length()
+        self.table = np.full(size, -1, dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _slots(self, keys):
+        """Returns the home slots of keys, by Fibonacci hashing."""
+        h = keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (h >> np.uint64(32)).astype(np.int64) & (len(self.table)-1)
+
+    def insert(self, keys):
+        """
+        Inserts an ndarray of keys, and returns a boolean ndarray marking
+        the keys that were not in the set. Of repeated keys within the
+        batch, only the first is marked.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if 2*(self.size + len(keys)) > len(self.table):
+            self._grow(self.size + len(keys))
+
+        new = np.zeros(len(keys), dtype=bool)
+        pending = np.arange(len(keys))
+        slots = self._slots(keys)
+        mask = len(self.table) - 1
+        while len(pending):
+            found = self.table[slots]
+            empty = found == -1
+            # Claim empty slots; of keys racing for one slot, one wins.
+            claim = pending[empty]
+            self.table[slots[empty]] = keys[claim]
+            won = empty & (self.table[slots] == keys[pending])
+            first = np.zeros(len(pending), dtype=bool)
+            _, index = np.unique(slots[won], return_index=True)
+            first[np.flatnonzero(won)[index]] = True
+            new[pending[first]] = True
+
+            done = (found == keys[pending]) | won
+            pending = pending[~done]
+            slots = (slots[~done] + 1) & mask
+        self.size += int(np.sum(new))
+        return new
+
+    def __contains__(self, key):
+        return bool(self.contains(np.array([key]))[0])
+
+    def contains(self, keys):
+        """Returns a boolean ndarray marking the keys in the set."""
+        keys = np.asarray(keys, dtype=np.int64)
+        result = np.zeros(len(keys), dtype=bool)
+        pending = np.arange(len(keys))
+        slots = self._slots(keys)
+        mask = len(self.table) - 1
+        while len(pending):
+            found = self.table[slots]
+            result[pending[found == keys[pending]]] = True
+            more = (found != -1) & (found != keys[pending])
+            pending = pending[more]
+            slots = (slots[more] + 1) & mask
+        return result
+
+    def keys(self):
+        """Returns the keys in the set, sorted."""
+        return np.sort(self.table[self.table >= 0])
+
+    def _grow(self, size):
+        keys = self.table[self.table >= 0]
+        self.table = np.full(1 << (size*4 - 1).bit_length(), -1,
+                                dtype=np.int64)
+        self.size = 0
+        self.insert(keys)
+
+##########
+# GUARDS #
+##########
+
+def _guard_classes(model, lo, hi, integral=False):
+    """
+    Splits the guards of a model by their value on the box (lo, hi):
+    returns the guards that are unsatisfiable on it, and those that may
+    be false on it. The remaining guards hold on the whole box.
+    """
+    dead = []
+    live = []
+    for guard in model.guard_list:
+        value = classify(guard.formula, lo, hi, integral)
+        if value is False:
+            dead.append(guard)
+        elif value is None:
+            live.append(guard)
+    return dead, live
+
+##############
+# EXHAUSTIVE #
+##############
+
+def reachable_configurations(model, lower, upper, init=None, config=None):
+    """
+    Returns the pairs of a state and an integer configuration that are
+    reachable in a GCGMP with integer payoffs, by a breadth-first search
+    restricted to the configurations within the bounds. Returns the states
+    as an ndarray of shape (V,), the configurations as an ndarray of shape
+    (V, players), and whether some move leaves the bounds.
+
+    Each pair is encoded as one integer key, and visited keys are kept in a
+    KeySet. All moves from the whole frontier are expanded together. Guards
+    that are unsatisfiable within the bounds are removed beforehand, and
+    guards that hold everywhere within the bounds are not evaluated.
+
+    Keyword arguments
+    model -- a GuardedConcurrentGameModelPayoffs
+    lower -- the lowest configuration value of each player
+    upper -- the highest configuration value of each player
+    init -- the initial state (default the current state)
+    config -- the initial configuration (default the current configuration)
+    """
+    lower = np.asarray(lower, dtype=np.int64)
+    upper = np.asarray(upper, dtype=np.int64)
+    init = model.cstate if init is None else init
+    config = model.config if config is None else config
+    config = np.asarray(config)
+
+    packed = model.pack()
+    if np.any(packed.payoffs != np.round(packed.payoffs)) or \
+            np.any(config != np.round(config)):
+        raise ValueError("Payoffs and configuration must be integral.")
+    payoffs = packed.payoffs.astype(np.int64)
+
+    sizes = upper - lower + 1
+    radix = np.ones(len(sizes), dtype=np.int64)
+    radix[:-1] = np.cumprod(sizes[::-1])[::-1][1:]
+    if np.prod(sizes.astype(float)) * packed.states >= 2.0**63:
+        raise ValueError("Too many pairs to encode.")
+    span = int(np.prod(sizes))
+
+    def encode(states, configs):
+        return states * span + (configs - lower) @ radix
+
+    def decode(keys):
+        rest = keys % span
+        configs = (rest[:, None] // radix) % sizes + lower
+        return keys // span, configs
+
+    dead, live = _guard_classes(model, lower, upper, True)
+    guarded = {}
+    for guard in dead + live:
+        guarded.setdefault(guard.state, []).append(guard)
+    dead = set(map(id, dead))
+
+    visited = KeySet()
+    states = np.array([ init ], dtype=np.int64)
+    configs = np.array([ config ], dtype=np.int64)
+    if np.any(configs < lower) or np.any(configs > upper):
+        raise ValueError("Initial configuration must be within the bounds.")
+    visited.insert(encode(states, configs))
+    escaped = False
+
+    while len(states):
+        masks = [ m[states] for m in model.padded_masks ]
+        for state in np.intersect1d(list(guarded), states):
+            rows = np.flatnonzero(states == state)
+            for guard in guarded[state]:
+                if id(guard) in dead:
+                    masks[guard.player][rows, guard.action] = False
+                else:
+                    masks[guard.player][rows, guard.action] = \
+                        guard.batch(configs[rows])
+
+        valid = packed.transitions[states] >= 0
+        for i, mask in enumerate(masks):
+            shape = [1] * valid.ndim
+            shape[0] = len(states)
+            shape[i+1] = mask.shape[1]
+            valid &= mask.reshape(shape)
+
+        moves = np.nonzero(valid)
+        index = (states[moves[0]],) + moves[1:]
+        targets = packed.transitions[index]
+        reached = configs[moves[0]] + payoffs[index]
+
+        inside = np.all((reached >= lower) & (reached <= upper), axis=1)
+        escaped = escaped or not np.all(inside)
+        keys = np.unique(encode(targets[inside], reached[inside]))
+        keys = keys[visited.insert(keys)]
+        states, configs = decode(keys)
+
+    states, configs = decode(visited.keys())
+    return states, configs, escaped
+
+############
+# SYMBOLIC #
+############
+
+def reachable_regions(model, init=None, config=None, lower=None, upper=None,
+                        widen=3):
+    """
+    Returns, for each state of a GCGMP, a box of configurations containing
+    every configuration with which the state is reachable. Returns a boolean
+    ndarray of shape (states,) marking the states that may be reachable, and
+    the lower and upper bounds of the boxes, as ndarrays of shape
+    (states, players).
+
+    The box of each state is the hull of everything that reaches it, so the
+    result over-approximates the reachable pairs. From a box, the moves of
+    a player's action are restricted to the part of the box satisfying its
+    guard (see refine), and actions whose guards are unsatisfiable there are
+    pruned. Once the box of a state has grown more than widen times, bounds
+    that still move are widened to infinity, or to lower and upper, so that
+    the fixed point is reached in finitely many steps.
+
+    Keyword arguments
+    model -- a GuardedConcurrentGameModelPayoffs
+    init -- the initial state (default the current state)
+    config -- the initial configuration (default the current configuration)
+    lower -- the configurations considered, if bounded (default None)
+    upper -- see lower (default None)
+    widen -- the number of growths of a box before widening (default 3)
+    """
+    players = model.players
+    states = len(model.states)
+    init = model.cstate if init is None else init
+    config = model.config if config is None else config
+    lower = np.full(players, -np.inf) if lower is None else \
+                np.asarray(lower, dtype='float64')
+    upper = np.full(players, np.inf) if upper is None else \
+                np.asarray(upper, dtype='float64')
+
+    reached = np.zeros(states, dtype=bool)
+    lo = np.full((states, players), np.inf)
+    hi = np.full((states, players), -np.inf)
+    growths = np.zeros(states, dtype=np.intp)
+
+    start = np.array(config, dtype='float64')
+    if np.any(start < lower) or np.any(start > upper):
+        raise ValueError("Initial configuration must be within the bounds.")
+    reached[init] = True
+    lo[init] = hi[init] = start
+    work = [ init ]
+    queued = { init }
+
+    while work:
+        state = work.pop()
+        queued.discard(state)
+        box = (lo[state], hi[state])
+
+        # Refine the box by the guard of each action of each player
+        transitions = np.asarray(model.transitions[state])
+        allowed = []
+        for player in range(players):
+            n = transitions.shape[player]
+            guards = model.guards[state][player]
+            p_lo = np.tile(box[0], (n, 1))
+            p_hi = np.tile(box[1], (n, 1))
+            ok = np.ones(n, dtype=bool)
+            for action, guard in guards.items():
+                refined = refine(guard.formula, *box)
+                if refined is None:
+                    ok[action] = False
+                else:
+                    p_lo[action], p_hi[action] = refined
+            allowed.append((ok, p_lo, p_hi))
+
+        moves = np.argwhere(np.ones(transitions.shape, dtype=bool))
+        keep = np.all([ allowed[p][0][moves[:, p]] for p in range(players) ],
+                        axis=0)
+        moves = moves[keep]
+        if len(moves) == 0:
+            continue
+        m_lo = np.max([ allowed[p][1][moves[:, p]] for p in range(players) ],
+                        axis=0)
+        m_hi = np.min([ allowed[p][2][moves[:, p]] for p in range(players) ],
+                        axis=0)
+        payoffs = model.games[state].mat[tuple(moves.T)]
+        t_lo = np.maximum(m_lo + payoffs, lower)
+        t_hi = np.minimum(m_hi + payoffs, upper)
+        targets = transitions[tuple(moves.T)]
+
+        feasible = np.all((m_lo <= m_hi) & (t_lo <= t_hi), axis=1)
+        for t, a, b in zip(targets[feasible], t_lo[feasible],
+                            t_hi[feasible]):
+            new_lo = np.minimum(lo[t], a)
+            new_hi = np.maximum(hi[t], b)
+            if reached[t] and np.all(new_lo == lo[t]) and \
+                    np.all(new_hi == hi[t]):
+                continue
+            if reached[t]:
+                growths[t] += 1
+                if growths[t] > widen:
+                    new_lo = np.where(new_lo < lo[t], lower, new_lo)
+                    new_hi = np.where(new_hi > hi[t], upper, new_hi)
+            reached[t] = True
+            lo[t] = new_lo
+            hi[t] = new_hi
+            if t not in queued:
+                queued.add(t)
+                work.append(t)
+
+    return reached, lo, hi
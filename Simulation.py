@@ -0,0 +1,428 @@
+"""
+Simulation - A module for batched simulation of games, using numpy.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from games import MixedStateBasedStrategy
+from Strategy import StateSegmentationStrategy, PackedSegmentationStrategy
+
+class BatchedPlays:
+    """
+    A batch of independent plays of a Guarded Concurrent Game Model with
+    Payoffs, advanced simultaneously.
+
+    The current states are stored as an ndarray of shape (N,) and the
+    configurations as an ndarray of shape (N, players). The model is packed
+    into a RaggedModel, so that each step of the whole batch is a single
+    fancy-indexing operation. For a MappedModel, the ragged packing is the
+    mapped arrays themselves, so nothing of the size of the model is
+    copied.
+    """
+    def __init__(self, gcgmp, plays, init=0, config=None, rng=None):
+        """
+        Initialize a batch of plays.
+
+        Keyword arguments
+        gcgmp -- a GuardedConcurrentGameModelPayoffs
+        plays -- the number N of plays in the batch
+        init -- the initial state of every play (default 0)
+        config -- the initial configuration of every play (default zeros)
+        rng -- a numpy Generator used for sampling (default a fresh one)
+        """
+        self.model = gcgmp
+        self.plays = plays
+        self.players = gcgmp.players
+        self.rng = np.random.default_rng() if rng is None else rng
+        self._profile = (None, None)
+
+        self.packed = gcgmp.pack(ragged=True)
+        self.actions = tuple(int(n) for n in self.packed.shapes.max(axis=0))
+
+        if config is None:
+            self.init_config = np.zeros(self.players)
+        else:
+            self.init_config = np.array(config, dtype='float64')
+
+        self.reset(init)
+
+    def reset(self, init=0):
+        """Moves every play back to the initial state and configuration."""
+        self.states = np.full(self.plays, init, dtype=np.intp)
+        self.config = np.tile(self.init_config, (self.plays, 1))
+        self.steps = 0
+        self._masks = (None, None)
+
+    def available(self):
+        """
+        Returns the availability masks of the model for the current states
+        and configurations, as computed by available_batch. They are computed
+        at most once per step.
+        """
+        if self._masks[0] != self.steps:
+            self._masks = (self.steps, self.model.available_batch(
+                                self.states, self.config))
+        return self._masks[1]
+
+    def move(self, moves):
+        """
+        Make one joint move in every play.
+
+        Keyword arguments
+        moves -- an integer ndarray of shape (N, players)
+        """
+        moves = np.asarray(moves, dtype=np.intp)
+        targets, payoffs = self.packed.step(self.states, moves)
+        if self.model.guard_list:
+            masks = self.available()
+            rows = np.arange(self.plays)
+            if not all(np.all(masks[p][rows, moves[:, p]])
+                        for p in range(self.players)):
+                raise ValueError("The move is not available.")
+
+        self.config += payoffs
+        self.states = targets
+        self.steps += 1
+
+    def sample(self, profile):
+        """
+        Samples a joint move for every play from a profile with one strategy
+        for each player. A strategy is either a MixedStateBasedStrategy or a
+        StateSegmentationStrategy, which chooses the action from the current
+        state and the player's own coordinate of the configuration.
+
+        If the model has guards, mixed strategies are restricted to the
+        available actions and renormalized.
+        """
+        tables = self._tables(profile)
+        masks = self.available() if self.model.guard_list else None
+        moves = np.empty((self.plays, self.players), dtype=np.intp)
+        for player in range(self.players):
+            if type(tables[player]) is PackedSegmentationStrategy:
+                moves[:, player] = tables[player](self.states,
+                                                    self.config[:, player])
+                continue
+            if masks is None:
+                moves[:, player] = profile[player].sample(self.states,
+                                                            self.rng)
+                continue
+            dist = tables[player][self.states] * masks[player]
+            cumm = np.cumsum(dist, axis=1)
+            total = cumm[:, -1]
+            if np.any(total <= 0):
+                raise ValueError("No available action has positive "
+                    + "probability.")
+            u = self.rng.random(self.plays) * total
+            moves[:, player] = np.sum(cumm <= u[:, None], axis=1)
+        return moves
+
+    def run(self, profile, steps):
+        """
+        Advances every play by the given number of steps, with moves sampled
+        from profile. Returns the average payoff per step of each play, as an
+        ndarray of shape (N, players).
+        """
+        start = self.config.copy()
+        for _ in range(steps):
+            self.move(self.sample(profile))
+        return (self.config - start) / max(steps, 1)
+
+    def _tables(self, profile):
+        """
+        Returns, for each player, the distributions of the player's strategy
+        in every state, as an ndarray of shape (states, n_max) padded with
+        zeros, or the packed form of a segmentation strategy.
+        """
+        if self._profile[0] is profile:
+            return self._profile[1]
+        if len(profile) != self.players:
+            raise ValueError("Number of strategy profiles must match number "
+                + "of players in CGM.")
+        if any(type(s) not in (MixedStateBasedStrategy,
+                    StateSegmentationStrategy) for s in profile):
+            raise TypeError("Strategies must be MixedStateBasedStrategy or "
+                + "StateSegmentationStrategy.")
+
+        tables = []
+        for player, strategy in enumerate(profile):
+            if strategy.states != len(self.model.states):
+                raise ValueError("Number of states in strategy profile must "
+                    + "match number of states in CGM.")
+            if type(strategy) is StateSegmentationStrategy:
+                tables.append(strategy.packed())
+                continue
+            table = np.zeros((strategy.states, self.actions[player]))
+            for state in range(strategy.states):
+                table[state, :len(strategy[state])] = strategy[state].dist
+            tables.append(table)
+
+        self._profile = (profile, tables)
+        return tables
+
+class PlayStatistics:
+    """
+    Summary statistics of the average payoffs and final configurations of a
+    number of plays. Statistics of disjoint sets of plays are combined with
+    merge, which uses the pairwise update of Chan et al. for the variance.
+    """
+    def __init__(self, payoffs=None, config=None):
+        """
+        Initialize statistics from the per-play average payoffs and final
+        configurations, both ndarrays of shape (N, players).
+        """
+        if payoffs is None:
+            self.plays = 0
+            return
+
+        self.plays = len(payoffs)
+        self.mean = np.mean(payoffs, axis=0)
+        self.m2 = np.sum((payoffs - self.mean)**2, axis=0)
+        self.config_mean = np.mean(config, axis=0)
+        self.config_min = np.min(config, axis=0)
+        self.config_max = np.max(config, axis=0)
+
+    def merge(self, other):
+        """Returns the statistics of the union of the two sets of plays."""
+        if self.plays == 0:
+            return other
+        if other.plays == 0:
+            return self
+
+        merged = PlayStatistics()
+        merged.plays = self.plays + other.plays
+        w = other.plays / merged.plays
+        delta = other.mean - self.mean
+        merged.mean = self.mean + delta*w
+        merged.m2 = self.m2 + other.m2 + delta**2*self.plays*w
+        merged.config_mean = self.config_mean + \
+                                (other.config_mean - self.config_mean)*w
+        merged.config_min = np.minimum(self.config_min, other.config_min)
+        merged.config_max = np.maximum(self.config_max, other.config_max)
+        return merged
+
+    def variance(self):
+        """Returns the sample variance of the average payoffs."""
+        return self.m2 / max(self.plays - 1, 1)
+
+    def __str__(self):
+        txt = "Plays: " + str(self.plays) + "\n"
+        if self.plays > 0:
+            txt += "Mean payoff: " + str(self.mean) + "\n"
+            txt += "Payoff variance: " + str(self.variance()) + "\n"
+            txt += "Mean configuration: " + str(self.config_mean) + "\n"
+        return txt
+
+class SkipAheadPlay:
+    """
+    A play of a GCGMP under a profile of StateSegmentationStrategy, one for
+    each player, which is deterministic. Such a play typically settles into
+    a cycle of states, along which the configuration grows by a fixed vector
+    each time the cycle repeats, until a coordinate crosses a point of a
+    segmentation or a guard changes value.
+
+    The play is advanced with move on the model, remembering where each
+    state was last visited. When a state repeats, the steps in between are a
+    candidate cycle. Along the repetitions of the cycle, every configuration
+    moves on a line, so the number of repetitions before it leaves the
+    segment of a strategy, or crosses the bound of a constraint of a guard
+    on a chosen action, is computed in closed form. The play then jumps over
+    that many repetitions at once.
+
+    The steps of skipped cycles are not appended to the history of the
+    model; they are summarized in skips.
+    """
+    def __init__(self, gcgmp, profile):
+        """
+        Keyword arguments
+        gcgmp -- a GuardedConcurrentGameModelPayoffs, which is played
+        profile -- a list of StateSegmentationStrategy, one for each player
+        """
+        if len(profile) != gcgmp.players:
+            raise ValueError("Number of strategy profiles must match number "
+                + "of players in CGM.")
+        if any(type(s) is not StateSegmentationStrategy for s in profile):
+            raise TypeError("Strategies must be StateSegmentationStrategy.")
+
+        self.model = gcgmp
+        self.profile = profile
+        self.tables = [ s.packed() for s in profile ]
+        self.steps = 0
+        self.skipped = 0
+        self.skips = []
+
+    def run(self, steps):
+        """
+        Advances the play by the given number of steps and returns the
+        configuration of the model.
+        """
+        model = self.model
+        end = self.steps + steps
+        seen = {}
+        trace = []
+        while self.steps < end:
+            state = model.cstate
+            if state in seen:
+                self._skip(trace[seen[state]:], end)
+                seen = {}
+                trace = []
+                if self.steps >= end:
+                    break
+                state = model.cstate
+
+            seen[state] = len(trace)
+            move = tuple(int(s(state, model.config[p]))
+                            for p, s in enumerate(self.profile))
+            trace.append((state, move, model.config.copy()))
+            model.move(move)
+            self.steps += 1
+        return model.config
+
+    def _skip(self, cycle, end):
+        """
+        Jumps over as many repetitions of cycle, a list of the (state, move,
+        configuration) of each step since the current state was last
+        visited, as are certain to be played identically. Returns the number
+        of repetitions skipped.
+        """
+        model = self.model
+        length = len(cycle)
+        states = np.array([ c[0] for c in cycle ], dtype=np.intp)
+        configs = np.array([ c[2] for c in cycle ])
+        delta = model.config - configs[0]
+
+        # The first repetition has been played; repetition t starts at
+        # configs + t*delta. Find the last t that is played identically.
+        x, d, bounds = self._intervals(states, configs, cycle, delta)
+        limit = _steady(x, d, *bounds)
+        count = int(min(limit, (end - self.steps) // length))
+        while count > 0 and not np.all(_inside(x + count*d, *bounds)):
+            count //= 2
+        if count == 0:
+            return 0
+
+        model.config = model.config + count*delta
+        self.steps += count*length
+        self.skipped += count*length
+        self.skips.append((self.steps, length, count))
+        return count
+
+    def _intervals(self, states, configs, cycle, delta):
+        """
+        Returns the values along the cycle that decide its moves, their
+        change per repetition and the intervals they must stay in: the
+        configuration of each player within the current segment of the
+        player's strategy, and the value of each constraint of a guard on a
+        chosen action within its bounds or outside of them.
+        """
+        x = []
+        d = []
+        bounds = [ [], [], [], [] ]
+        for player, table in enumerate(self.tables):
+            k = table.segment(states, configs[:, player])
+            first = table.offsets[states]
+            points = np.concatenate([ [-np.inf], table.points, [np.inf] ])
+            closed = np.concatenate([ [False], table.closed, [False] ])
+            lower = np.where(k > 0, first + k, 0)
+            upper = np.where(k < table.offsets[states+1] - first, first+k+1,
+                                len(points)-1)
+            x.append(configs[:, player])
+            d.append(np.full(len(states), delta[player]))
+            bounds[0].append(points[lower])
+            bounds[1].append(points[upper])
+            bounds[2].append(closed[lower])
+            bounds[3].append(~closed[upper])
+
+        for (state, move, config) in cycle:
+            for player in range(self.model.players):
+                guard = self.model.guards[state][player].get(move[player])
+                if guard is None or len(guard.compiled.lb) == 0:
+                    continue
+                c = guard.compiled
+                v = c.A @ config
+                below = v < c.lb
+                above = ~below & (v > c.ub)
+                x.append(v)
+                d.append(c.A @ delta)
+                bounds[0].append(np.where(above, c.ub,
+                                    np.where(below, -np.inf, c.lb)))
+                bounds[1].append(np.where(below, c.lb,
+                                    np.where(above, np.inf, c.ub)))
+                bounds[2].append(~below & ~above)
+                bounds[3].append(~below & ~above)
+
+        return np.concatenate(x), np.concatenate(d), \
+                    [ np.concatenate(b) for b in bounds ]
+
+def _inside(x, lower, upper, lower_closed, upper_closed):
+    """Returns a boolean ndarray marking the values within their
+    intervals."""
+    return ((x > lower) | (lower_closed & (x == lower))) & \
+                ((x < upper) | (upper_closed & (x == upper)))
+
+def _steady(x, d, lower, upper, lower_closed, upper_closed):
+    """
+    Returns the largest t such that x + t*d stays within the intervals for
+    all values, which are within them at t = 0, or inf if no value moves
+    towards an endpoint.
+    """
+    gap = np.where(d > 0, upper - x, x - lower)
+    open_end = np.where(d > 0, ~upper_closed, ~lower_closed)
+    moving = (d != 0) & np.isfinite(gap)
+    if not np.any(moving):
+        return np.inf
+    gap = gap[moving]
+    rate = np.abs(d[moving])
+    t = np.floor(gap / rate)
+    t -= open_end[moving] & (t*rate >= gap)
+    return max(float(np.min(t)), 0.0)
+
+def _simulate_chunk(gcgmp, profile, plays, steps, seed, init, config):
+    """Runs one worker's share of the plays and returns its statistics."""
+    if hasattr(gcgmp, 'attach'):
+        gcgmp = gcgmp.attach()
+    batch = BatchedPlays(gcgmp, plays, init, config,
+                            np.random.default_rng(seed))
+    payoffs = batch.run(profile, steps)
+    return PlayStatistics(payoffs, batch.config)
+
+def parallel_run(gcgmp, profile, plays, steps, seed=None, workers=None,
+                    init=0, config=None):
+    """
+    Runs plays of a GCGMP over a process pool and returns the merged
+    PlayStatistics.
+
+    The plays are split into one contiguous chunk per worker, and each worker
+    samples from its own Generator, seeded by a child of
+    np.random.SeedSequence(seed). Results are merged in worker order, so that
+    they are identical for a given seed and number of workers.
+
+    Keyword arguments
+    gcgmp -- a GuardedConcurrentGameModelPayoffs, or a SharedModel which
+    each worker attaches to
+    profile -- a list of MixedStateBasedStrategy, one for each player
+    plays -- the total number of plays
+    steps -- the number of steps of each play
+    seed -- the root seed (default None, i.e. fresh entropy)
+    workers -- the number of worker processes (default os.cpu_count())
+    init -- the initial state (default 0)
+    config -- the initial configuration (default zeros)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, plays))
+
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    chunks = [ plays // workers + (i < plays % workers)
+                for i in range(workers) ]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [ pool.submit(_simulate_chunk, gcgmp, profile, chunks[i],
+                                    steps, seeds[i], init, config)
+                    for i in range(workers) ]
+        results = [ f.result() for f in futures ]
+
+    stats = PlayStatistics()
+    for result in results:
+        stats = stats.merge(result)
+    return stats
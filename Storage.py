@@ -0,0 +1,356 @@
+"""
+Storage - A module for storing games on disk, using numpy.
+"""
+
+import os
+import json
+import numpy as np
+from multiprocessing import shared_memory
+from games import Game, GuardedConcurrentGameModelPayoffs, RaggedModel, \
+                    ConcurrentGameModel, Guard
+from PresburgerArithmetic import PAFormula, LinearConstraint
+
+FORMAT_VERSION = 1
+
+################
+# MODEL FORMAT #
+################
+
+def save_model(model, path):
+    """
+    Saves a GuardedConcurrentGameModelPayoffs to the directory path.
+
+    The directory holds a small header.json and one .npy file per array:
+    the ragged transitions and payoffs of the model (see RaggedModel), the
+    shape of each state, and the guards sorted by state, with per-state
+    offsets. The linear constraints of all guards are stacked into one
+    coefficient matrix with bound vectors, and the Boolean structure of each
+    guard is stored as JSON in guard_trees.bin, with per-guard byte offsets.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays, header = _serialize(model)
+    for name, array in arrays.items():
+        if name == 'guard_trees':
+            with open(os.path.join(path, 'guard_trees.bin'), 'wb') as f:
+                f.write(array.tobytes())
+        else:
+            np.save(os.path.join(path, name + '.npy'), array)
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+def load_model(path):
+    """Opens a model saved by save_model as a MappedModel, with all arrays
+    opened by np.memmap."""
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+
+    arrays = {}
+    for name in _ARRAYS:
+        arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode='r')
+    if header['guards'] > 0:
+        arrays['guard_trees'] = np.memmap(os.path.join(path,
+                                    'guard_trees.bin'), dtype=np.uint8,
+                                    mode='r')
+    else:
+        arrays['guard_trees'] = np.zeros(0, dtype=np.uint8)
+
+    model = MappedModel(arrays, header)
+    model.path = path
+    return model
+
+_ARRAYS = [ 'shapes', 'transitions', 'payoffs', 'guard_offsets',
+            'guard_index', 'guard_A', 'guard_lb', 'guard_ub',
+            'guard_tree_offsets' ]
+
+def _serialize(model):
+    """Returns the arrays and the header describing a model."""
+    ragged = model.pack(ragged=True)
+
+    guards = sorted(model.guard_list, key=lambda g: g.state)
+    counts = np.bincount(np.array([ g.state for g in guards ], dtype=np.intp),
+                            minlength=len(model.states))
+    guard_offsets = np.zeros(len(model.states)+1, dtype=np.intp)
+    guard_offsets[1:] = np.cumsum(counts)
+
+    rows = []
+    trees = []
+    for g in guards:
+        compiled = PAFormula(g.formula).compile()
+        base = len(rows)
+        rows.extend(compiled.constraints)
+        trees.append(json.dumps(_shift(compiled.tree, base)).encode())
+    tree_offsets = np.zeros(len(trees)+1, dtype=np.intp)
+    tree_offsets[1:] = np.cumsum([ len(t) for t in trees ])
+
+    arrays = {
+        'shapes' : ragged.shapes,
+        'transitions' : ragged.transitions,
+        'payoffs' : ragged.payoffs,
+        'guard_offsets' : guard_offsets,
+        'guard_index' : np.array([ (g.state, g.player, g.action)
+                                    for g in guards ],
+                                    dtype=np.intp).reshape(-1, 3),
+        'guard_A' : np.array([ c.A for c in rows ],
+                                dtype='float64').reshape(-1, model.players),
+        'guard_lb' : np.array([ c.lb for c in rows ], dtype='float64'),
+        'guard_ub' : np.array([ c.ub for c in rows ], dtype='float64'),
+        'guard_tree_offsets' : tree_offsets,
+        'guard_trees' : np.frombuffer(b''.join(trees), dtype=np.uint8),
+    }
+    header = {
+        'version' : FORMAT_VERSION,
+        'states' : len(model.states),
+        'players' : int(model.players),
+        'init' : int(model.cstate),
+        'config' : [ float(v) for v in model.config ],
+        'guards' : len(guards),
+    }
+    return arrays, header
+
+def _shift(node, base):
+    """Offsets the constraint leaves of a CompiledFormula tree by base."""
+    if node[0] == 'c':
+        return ['c', node[1] + base]
+    elif node[0] == 't':
+        return list(node)
+    return [node[0]] + [ _shift(ch, base) for ch in node[1:] ]
+
+class MappedModel(GuardedConcurrentGameModelPayoffs):
+    """
+    A GuardedConcurrentGameModelPayoffs on the arrays of a serialized
+    model, which are typically memory-mapped files (see load_model) or
+    shared memory (see SharedModel). Nothing is copied, so that opening is
+    near-instant and processes opening the same model share its pages. The
+    transitions, games and guards of a state are built on first access.
+
+    Guards are evaluated directly at the current configuration, since
+    incremental evaluation would need all guards to be loaded.
+    """
+    def __init__(self, arrays, header):
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError("Unsupported model format version.")
+
+        load = arrays.get
+        shapes = np.asarray(load('shapes'))
+        self.ragged = RaggedModel.from_arrays(shapes, load('transitions'),
+                                                load('payoffs'))
+
+        ConcurrentGameModel.__init__(self, _MappedTransitions(self.ragged),
+                                        header['init'], False)
+        self.games = _MappedGames(self.ragged)
+        self.config = np.array(header['config'], dtype='float64')
+
+        index = load('guard_index')
+        self.guards = _MappedGuards(self, load('guard_offsets'), index,
+                        load('guard_A'), load('guard_lb'), load('guard_ub'),
+                        load('guard_tree_offsets'), load('guard_trees'))
+        self.guard_list = _MappedGuardList(self.guards, index)
+        self.guarded_states = np.unique(np.array(index[:, 0]))
+        self.masks = _DefaultMasks(shapes)
+        self.padded_masks = [ _PaddedMasks(shapes[:, i], n)
+                                for i, n in enumerate(shapes.max(axis=0)) ]
+        self._evaluator = None
+        self._index = None
+
+    def set_guards(self, guards):
+        raise TypeError("Guards of a mapped model cannot be changed.")
+
+    def pack(self, ragged=False):
+        """Returns the model packed. The ragged packing is the mapped
+        arrays themselves."""
+        if ragged:
+            return self.ragged
+        return GuardedConcurrentGameModelPayoffs.pack(self, ragged)
+
+class _MappedTransitions:
+    """The transition matrices of a RaggedModel, as views."""
+    def __init__(self, ragged):
+        self.ragged = ragged
+
+    def __len__(self):
+        return self.ragged.states
+
+    def __getitem__(self, state):
+        r = self.ragged
+        return r.transitions[r.offsets[state]:r.offsets[state+1]].reshape(
+                    r.shapes[state])
+
+class _MappedGames:
+    """The games of a RaggedModel, created on first access."""
+    def __init__(self, ragged):
+        self.ragged = ragged
+        self.cache = {}
+
+    def __len__(self):
+        return self.ragged.states
+
+    def __getitem__(self, state):
+        if state not in self.cache:
+            r = self.ragged
+            mat = r.payoffs[r.offsets[state]:r.offsets[state+1]].reshape(
+                    tuple(r.shapes[state]) + (r.players,))
+            self.cache[state] = Game(mat)
+        return self.cache[state]
+
+    def __iter__(self):
+        return (self[s] for s in range(len(self)))
+
+class _MappedGuards:
+    """The guard index of a MappedModel, indexed by state and built on
+    first access."""
+    def __init__(self, model, offsets, index, A, lb, ub, tree_offsets,
+                    trees):
+        self.players = model.players
+        self.offsets = offsets
+        self.index = index
+        self.A = A
+        self.lb = lb
+        self.ub = ub
+        self.tree_offsets = tree_offsets
+        self.trees = trees
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def guard(self, j):
+        """Reads guard number j."""
+        start, end = self.tree_offsets[j], self.tree_offsets[j+1]
+        tree = json.loads(bytes(self.trees[start:end]).decode())
+        state, player, action = ( int(v) for v in self.index[j] )
+        return Guard(state, player, action, self._decode(tree))
+
+    def _decode(self, node):
+        if node[0] == 'c':
+            i = node[1]
+            return PAFormula(LinearConstraint(np.array(self.A[i]),
+                                                self.lb[i], self.ub[i]))
+        elif node[0] == 't':
+            return PAFormula(node[1])
+        return PAFormula(node[0], [ self._decode(ch) for ch in node[1:] ])
+
+    def __getitem__(self, state):
+        if state not in self.cache:
+            guards = [ {} for _ in range(self.players) ]
+            for j in range(self.offsets[state], self.offsets[state+1]):
+                g = self.guard(j)
+                guards[g.player][g.action] = g
+            self.cache[state] = guards
+        return self.cache[state]
+
+class _MappedGuardList:
+    """All guards of a MappedModel, as a sequence."""
+    def __init__(self, guards, index):
+        self.guards = guards
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, j):
+        state, player, action = ( int(v) for v in self.index[j] )
+        return self.guards[state][player][action]
+
+class _DefaultMasks:
+    """The default availability masks of each state, built on access."""
+    def __init__(self, shapes):
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, state):
+        return [ np.ones(n, dtype=bool) for n in self.shapes[state] ]
+
+class _PaddedMasks:
+    """The padded availability masks of one player, built for the states
+    that are indexed."""
+    def __init__(self, actions, n):
+        self.actions = actions
+        self.n = n
+
+    def __getitem__(self, states):
+        return np.arange(self.n) < self.actions[states, None]
+
+#################
+# SHARED MEMORY #
+#################
+
+class SharedModel:
+    """
+    A model published in shared memory, so that worker processes can attach
+    zero-copy views of it instead of pickling or rebuilding the model.
+
+    The process creating a SharedModel owns the shared memory blocks and
+    must call close, or use it as a context manager, to free them. A
+    SharedModel pickles to a small description of the blocks, and attach
+    returns a MappedModel backed by read-only views of them.
+    """
+    def __init__(self, model):
+        arrays, self.header = _serialize(model)
+        self.spec = {}
+        self.blocks = []
+        self.owner = True
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True,
+                                                size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+            view[...] = array
+            self.blocks.append(block)
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+        self._model = None
+
+    def attach(self):
+        """Returns a MappedModel on read-only views of the shared arrays.
+        The model is created once per process."""
+        if self._model is None:
+            arrays = {}
+            for name, (block, shape, dtype) in self.spec.items():
+                if not self.owner:
+                    block = _attach_block(block)
+                    self.blocks.append(block)
+                else:
+                    block = next(b for b in self.blocks if b.name == block)
+                view = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+                view.flags.writeable = False
+                arrays[name] = view
+            self._model = MappedModel(arrays, self.header)
+        return self._model
+
+    def close(self):
+        """Releases the blocks, and frees them if this process owns them."""
+        self._model = None
+        for block in self.blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return { 'header' : self.header, 'spec' : self.spec }
+
+    def __setstate__(self, state):
+        self.header = state['header']
+        self.spec = state['spec']
+        self.blocks = []
+        self.owner = False
+        self._model = None
+
+def share_model(model):
+    """Publishes a GCGMP in shared memory and returns its SharedModel."""
+    return SharedModel(model)
+
+def _attach_block(name):
+    """Attaches an existing block. Where supported, the block is not tracked
+    in this process, since the process that created it frees it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
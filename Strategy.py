@@ -1,6 +1,5 @@
 import numpy as np
 import networkx as nx
-import intervals as I
 
 ##############
 # STRATEGIES #
@@ -64,18 +63,27 @@ class Segmentation:
 
         self.points = points
         self.delimiters = delimiters
+        self._points = np.asarray(points, dtype='float64')
+        self._closed = np.asarray(delimiters, dtype=bool)
 
     def __call__(self,x):
-        i = 0
-        while i < len(self.delimiters):
-            if self.delimiters[i] == 0 and not self.points[i] < x:
-                return i
-            elif self.delimiters[i] == 1 and not self.points[i] <= x:
-                return i
-            else:
+        """Returns the index of the segment containing x. If x is an array,
+        returns an array of indices of the same shape.
+
+        Point i belongs to segment i if its delimiter is 0 and to segment i+1
+        if it is 1, so the index is the number of points strictly below x,
+        plus one if x equals a point with delimiter 1.
+        """
+        i = np.searchsorted(self._points, x, side='left')
+        if np.ndim(i) == 0:
+            if i < len(self._points) and self._points[i] == x \
+                    and self._closed[i]:
                 i += 1
+            return int(i)
 
-        return i
+        j = np.minimum(i, len(self._points)-1)
+        return i + ((i < len(self._points)) & (self._points[j] == x)
+                        & self._closed[j])
 
     def __len__(self):
         return len(self.points)+1
@@ -123,9 +131,15 @@ class SegmentationStrategy(Segmentation):
 
         super().__init__(segmentation.points,segmentation.delimiters)
         self.actions = actions
+        self._actions = np.asarray(actions)
 
     def __call__(self,x):
-        return self.actions[super().__call__(x)]
+        """Returns the action of the segment containing x, or an array of
+        actions if x is an array."""
+        i = super().__call__(x)
+        if np.ndim(i) == 0:
+            return self.actions[i]
+        return self._actions[i]
 
 class StateSegmentationStrategy:
 
@@ -136,7 +150,263 @@ class StateSegmentationStrategy:
         if any( [ type(s) is not SegmentationStrategy for s in strategies ] ):
             raise ValueError("Strategies must be SegmentationStrategy.")
 
+        self.states = states
         self.strategies = strategies
+        self._packed = None
+
+    def __call__(self,state,x):
+        """Returns the action in state at value x. If state or x is an array,
+        the pairs are evaluated together by the packed form."""
+        if np.ndim(state) == 0:
+            return self.strategies[state](x)
+        return self.packed()(state,x)
+
+    def packed(self):
+        """Returns the PackedSegmentationStrategy of this strategy. It is
+        built once and cached."""
+        if self._packed is None:
+            self._packed = PackedSegmentationStrategy(self.strategies)
+        return self._packed
+
+class PackedSegmentationStrategy:
+    """A StateSegmentationStrategy with the segmentations of all states
+    stored in flat arrays, in the manner of a CSR matrix.
+
+    The points and delimiters of state s are points[offsets[s]:offsets[s+1]]
+    and closed[offsets[s]:offsets[s+1]], and its actions are
+    actions[offsets[s]+s:offsets[s+1]+s+1], since each state has one more
+    segment than points.
+
+    Parameters
+    ----------
+    strategies : list
+        A SegmentationStrategy for each state.
+
+    Attributes
+    ----------
+    points : array
+        The points of all states, concatenated.
+    closed : array
+        The delimiters of all states, as booleans.
+    offsets : array
+        The index of the first point of each state, followed by the total
+        number of points.
+    actions : array
+        The actions of all states, concatenated.
+    """
+    def __init__(self,strategies):
+        if any( [ type(s) is not SegmentationStrategy for s in strategies ] ):
+            raise ValueError("Strategies must be SegmentationStrategy.")
+
+        lengths = [ len(s.points) for s in strategies ]
+        self.states = len(strategies)
+        self.offsets = np.zeros(self.states+1, dtype=np.intp)
+        self.offsets[1:] = np.cumsum(lengths)
+        self.points = np.concatenate([ s._points for s in strategies ]
+                                        + [np.zeros(0)])
+        self.closed = np.concatenate([ s._closed for s in strategies ]
+                                        + [np.zeros(0, dtype=bool)])
+        self.actions = np.concatenate([ s._actions for s in strategies ])
+        self._depth = int(max(lengths, default=0)).bit_length()
+
+    def segment(self,state,x):
+        """Returns the index of the segment containing x[k] in the
+        segmentation of state[k], for arrays state and x of equal length.
+
+        All searches are advanced together by a vectorized bisection within
+        each state's slice of the points.
+        """
+        state = np.asarray(state, dtype=np.intp)
+        x = np.asarray(x, dtype='float64')
+        lo = self.offsets[state]
+        end = self.offsets[state+1]
+        hi = end.copy()
+
+        for _ in range(self._depth):
+            active = lo < hi
+            mid = (lo + hi) // 2
+            below = active & (self.points[np.minimum(mid, len(self.points)-1)]
+                                < x)
+            lo = np.where(below, mid+1, lo)
+            hi = np.where(active & ~below, mid, hi)
+
+        j = np.minimum(lo, len(self.points)-1)
+        lo = lo + ((lo < end) & (self.points[j] == x) & self.closed[j])
+        return lo - self.offsets[state]
 
     def __call__(self,state,x):
-        return self.strategies[state](x)
+        """Returns the actions for arrays of states and values."""
+        state = np.asarray(state, dtype=np.intp)
+        return self.actions[self.offsets[state] + state
+                                + self.segment(state,x)]
+
+#################
+# INTERVAL SETS #
+#################
+
+class IntervalSet:
+    """A finite union of intervals of the real line, in a canonical form: a
+    sorted array of distinct breakpoints, and the membership of each of the
+    pieces they cut the line into. Piece 2i is the open gap below point i,
+    piece 2i+1 is point i itself, and the last piece is the gap above the
+    last point. Breakpoints whose piece and both neighbouring gaps agree are
+    removed, so that equal sets have equal arrays.
+
+    Parameters
+    ----------
+    points : array
+        The sorted, distinct breakpoints.
+    states : array
+        The membership of each of the 2*len(points)+1 pieces.
+    """
+    def __init__(self,points=(),states=(False,)):
+        self.points = np.asarray(points, dtype='float64')
+        self.states = np.asarray(states, dtype=bool)
+        if len(self.states) != 2*len(self.points)+1:
+            raise ValueError("There must be one state per point and gap.")
+
+    @classmethod
+    def interval(cls,lower,upper,left_closed=True,right_closed=True):
+        """Returns the interval between lower and upper, which is empty if
+        lower exceeds upper. Infinite endpoints are never included."""
+        left_closed = left_closed and lower > -np.inf
+        right_closed = right_closed and upper < np.inf
+        if lower > upper or (lower == upper
+                                and not (left_closed and right_closed)):
+            return cls()
+        if lower == upper:
+            return cls([lower],[False,True,False])
+
+        points = []
+        states = [lower == -np.inf]
+        if lower > -np.inf:
+            points.append(lower)
+            states += [left_closed,True]
+        if upper < np.inf:
+            points.append(upper)
+            states += [right_closed,False]
+        return cls(points,states)
+
+    @classmethod
+    def closed(cls,lower,upper):
+        return cls.interval(lower,upper,True,True)
+
+    @classmethod
+    def open(cls,lower,upper):
+        return cls.interval(lower,upper,False,False)
+
+    @classmethod
+    def closedopen(cls,lower,upper):
+        return cls.interval(lower,upper,True,False)
+
+    @classmethod
+    def openclosed(cls,lower,upper):
+        return cls.interval(lower,upper,False,True)
+
+    def contains(self,x):
+        """Returns a boolean array marking the values of x in the set, by
+        one searchsorted over the breakpoints."""
+        x = np.asarray(x, dtype='float64')
+        i = np.searchsorted(self.points, x, side='left')
+        j = np.minimum(i, max(len(self.points)-1, 0))
+        at = (i < len(self.points)) & (self.points[j] == x) \
+                if len(self.points) else np.zeros(x.shape, dtype=bool)
+        return self.states[2*i + at]
+
+    def __contains__(self,x):
+        return bool(self.contains(x))
+
+    def __or__(self,other):
+        return self._merge(other, np.logical_or)
+
+    def __and__(self,other):
+        return self._merge(other, np.logical_and)
+
+    def __invert__(self):
+        return IntervalSet(self.points, ~self.states)
+
+    def __sub__(self,other):
+        return self & ~other
+
+    def _merge(self,other,op):
+        """Combines two sets piecewise with the Boolean operator op. The
+        breakpoints are merged by a stable sort of the two sorted arrays,
+        which runs in linear time, and the piece of each set containing
+        each merged piece is found by counting breakpoints."""
+        points = np.concatenate([self.points, other.points])
+        first = np.concatenate([np.ones(len(self.points), dtype=bool),
+                                np.zeros(len(other.points), dtype=bool)])
+        order = np.argsort(points, kind='stable')
+        points = points[order]
+        first = first[order]
+
+        # Counts of each set's breakpoints up to and including each point
+        counts = [ np.cumsum(first), np.cumsum(~first) ]
+        last = np.ones(len(points), dtype=bool)
+        last[:-1] = points[1:] != points[:-1]
+        merged = points[last]
+
+        states = []
+        for count, source in zip(counts, (self, other)):
+            upto = count[last]
+            below = np.concatenate([[0], upto[:-1]])
+            on = upto > below
+            piece = np.empty(2*len(merged)+1, dtype=np.intp)
+            piece[0] = 0
+            piece[1::2] = np.where(on, 2*upto-1, 2*upto)
+            piece[2::2] = 2*upto
+            states.append(source.states[piece])
+        return IntervalSet._canonical(merged, op(*states))
+
+    @staticmethod
+    def _canonical(points,states):
+        """Removes the breakpoints that do not separate pieces."""
+        keep = (states[1::2] != states[0:-1:2]) | \
+                (states[1::2] != states[2::2])
+        index = np.flatnonzero(keep)
+        pieces = np.empty(2*len(index)+1, dtype=np.intp)
+        pieces[1::2] = 2*index+1
+        pieces[2::2] = 2*index+2
+        pieces[0] = 0
+        return IntervalSet(points[keep], states[pieces])
+
+    def intervals(self):
+        """Returns the maximal intervals of the set as arrays lower, upper,
+        left_closed and right_closed."""
+        n = len(self.points)
+        values = np.concatenate([[-np.inf], np.repeat(self.points, 2),
+                                    [np.inf]]).reshape(-1, 2)
+        # Pieces as (lower, upper) pairs: gaps span two points, a point is
+        # the degenerate interval at itself.
+        lows = np.empty(2*n+1)
+        highs = np.empty(2*n+1)
+        lows[0::2] = values[:, 0]
+        highs[0::2] = values[:, 1]
+        lows[1::2] = self.points
+        highs[1::2] = self.points
+
+        starts = self.states & ~np.concatenate([[False], self.states[:-1]])
+        ends = self.states & ~np.concatenate([self.states[1:], [False]])
+        start = np.flatnonzero(starts)
+        end = np.flatnonzero(ends)
+        return lows[start], highs[end], start % 2 == 1, end % 2 == 1
+
+    def empty(self):
+        return not np.any(self.states)
+
+    def __eq__(self,other):
+        return type(other) is IntervalSet and \
+                np.array_equal(self.points, other.points) and \
+                np.array_equal(self.states, other.states)
+
+    def __str__(self):
+        if self.empty():
+            return '()'
+        parts = []
+        for a, b, lc, rc in zip(*self.intervals()):
+            if a == b:
+                parts.append('[' + str(a) + ']')
+            else:
+                parts.append(('[' if lc else '(') + str(a) + ','
+                                + str(b) + (']' if rc else ')'))
+        return ' | '.join(parts)
@@ -6,7 +6,13 @@ __version__ = '0.1'
 __author__ = 'Daniel Ahlsén'
 import numpy as np
 import networkx as nx
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.sparse.csgraph import connected_components, breadth_first_order
 from itertools import groupby
+from collections import OrderedDict, deque
+from PresburgerArithmetic import PAFormula, IncrementalEvaluator, classify
+from History import PlayHistory
 
 ###############
 # GAME MODELS #
@@ -16,7 +22,7 @@ class Game:
     """Represents a game in normal form by an ndarray with shape 
     (n_1, ..., n_m, m)."""
     def __init__(self, payoffs, dtype='float64'):
-        self.mat = np.array(payoffs,dtype)
+        self.mat = np.asarray(payoffs,dtype)
         self.shape = np.shape(self.mat)
         self.players = self.mat.ndim-1
         
@@ -28,13 +34,79 @@ class Game:
         return self.mat[move]
 
     def expected_outcome(self,profile):
-        dist = expected_outcome(profile)
-        outcome = np.ones(self.players)
-        
-        for i in range(self.players):
-            outcome[i] = np.sum(self.mat[...,i]*dist)
+        """
+        Returns the expected payoff of each player under a mixed strategy 
+        profile. The payoff tensor is contracted against each player's 
+        distribution in turn, without forming the joint distribution.
         
-        return outcome
+        Keyword arguments
+        profile -- a list with one MixedStrategy or distribution for each 
+        player. Distributions may be ndarrays of shape (B, n_i), in which 
+        case an ndarray of shape (B, players) is returned.
+        """
+        dists, batched = self._dists(profile)
+        m = self.players
+        operands = [self.mat, list(range(m+1))]
+        for j in range(m):
+            operands += [dists[j], batched[j] + [j]]
+        out = ([m+2] if any(batched) else []) + [m]
+        return np.einsum(*operands, out, optimize=True)
+    
+    def action_payoffs(self,profile):
+        """
+        Returns, for each player, the payoff of each of the player's pure 
+        actions against the other players' strategies in profile, as a list
+        of ndarrays of shape (n_i,), or (B, n_i) for batched profiles as in 
+        expected_outcome.
+        """
+        dists, batched = self._dists(profile)
+        m = self.players
+        sizes = [ len(d) for d, b in zip(dists, batched) if b ]
+        payoffs = []
+        for i in range(m):
+            operands = [self.mat[...,i], list(range(m))]
+            for j in range(m):
+                if j != i:
+                    operands += [dists[j], batched[j] + [j]]
+            # Only the other players' distributions are contracted, so the
+            # batch axis is added afterwards if only player i's is batched.
+            batch = [m+2] if any(batched[:i] + batched[i+1:]) else []
+            p = np.einsum(*operands, batch + [i], optimize=True)
+            if sizes and not batch:
+                p = np.broadcast_to(p, (sizes[0],) + p.shape).copy()
+            payoffs.append(p)
+        return payoffs
+    
+    def best_responses(self,profile):
+        """
+        Returns, for each player, a boolean mask over the player's pure 
+        actions marking the best responses to the other players' strategies.
+        """
+        return [ p >= np.max(p, axis=-1, keepdims=True) - 1e-12 
+                    for p in self.action_payoffs(profile) ]
+    
+    def regret(self,profile):
+        """
+        Returns the regret of each player, i.e. how much the player could 
+        gain by deviating to a best response, as an ndarray of shape 
+        (players,) or (B, players).
+        """
+        dists, batched = self._dists(profile)
+        payoffs = self.action_payoffs(profile)
+        best = np.stack([ np.max(p, axis=-1) for p in payoffs ], axis=-1)
+        expected = np.stack([ np.sum(p*d, axis=-1) 
+                                for p, d in zip(payoffs, dists) ], axis=-1)
+        return best - expected
+    
+    def _dists(self,profile):
+        """Returns the distributions of a profile as ndarrays, and for each 
+        the batch axis label to use in einsum."""
+        if len(profile) != self.players:
+            raise ValueError("Profile must have one strategy per player.")
+        dists = [ np.asarray(p.dist if type(p) is MixedStrategy else p, 
+                                dtype='float64') for p in profile ]
+        batched = [ [self.players+2] if d.ndim == 2 else [] for d in dists ]
+        return dists, batched
         
     def __str__(self):
         return str(self.mat)
@@ -43,33 +115,43 @@ class ConcurrentGameModel:
     """
     A Concurrent Game Model as a list of integer matrices of equal dimension.
     """
-    def __init__(self, transitions, init = 0):
+    def __init__(self, transitions, init = 0, validate = True, history = None):
         """
         Initialize a Concurrent Game Model.
         
         Keyword arguments
         transitions -- a list of transition matrices
         init -- the initial state (default 0)
-        
-        TODO: Fix tests
-        
-        # Check that all dimensions match
-        dims = map(lambda x : np.ndim(x), self.transitions)
-        if all_equal(dims):
-            raise ValueError("Dimensions of transition matrices must match.")
-        
-        # Check that all transitions point to other states
-        for matrix in self.transitions:
-            if any(n < 0 or n >= len(transitions) for n in np.nditer(matrix)):
-                raise ValueError("All transitions must be to other states.")
+        validate -- check that the dimensions of all transition matrices 
+        match and that all transitions point to states (default True)
+        history -- the PlayHistory recording plays (default one keeping 
+        every step)
         """
         self.states = range(len(transitions))
         self.cstate = init
         self.transitions = transitions
         
         self.players = np.ndim(self.transitions[0])
-        self.shistory = []
-        self.mhistory = []
+        self.history = PlayHistory(self.players) if history is None \
+                        else history
+        
+        if validate:
+            self.validate()
+    
+    def pack(self, ragged=False):
+        """Returns the model packed into a PackedModel, or a RaggedModel if 
+        ragged is True."""
+        payoffs = None
+        if hasattr(self, 'games'):
+            payoffs = [ g.mat for g in self.games ]
+        if ragged:
+            return RaggedModel(self.transitions, payoffs)
+        return PackedModel(self.transitions, payoffs)
+    
+    def validate(self):
+        """Raises a ValueError if the model is malformed. The checks are 
+        vectorized over the ragged packing of the model."""
+        self.pack(ragged=True).validate()
         
     def move(self, move):
         """
@@ -79,9 +161,19 @@ class ConcurrentGameModel:
         move -- move to make
         """
         
-        self.shistory.append(self.cstate)
+        self.history.append(self.cstate, move)
         self.cstate = self.transitions[self.cstate][move]
-        self.mhistory.append(move)
+    
+    @property
+    def shistory(self):
+        """The states of the play, as an ndarray."""
+        return self.history.states()
+    
+    @property
+    def mhistory(self):
+        """The joint moves of the play, as an ndarray of shape 
+        (steps, players)."""
+        return self.history.moves()
     
     def __str__(self):
         txt = "Current state: " + str(self.cstate) + "\n" 
@@ -91,42 +183,164 @@ class ConcurrentGameModel:
         
     def reset(self, init = 0):
         self.cstate = init
-        self.shistory = []
-        self.mhistory = []
+        self.history.clear()
 
 class GuardedConcurrentGameModelPayoffs(ConcurrentGameModel):
     """
     A Guarded Concurrent Game Model with Payoffs is a Concurrent Game Model 
     (CGM) with a strategic game in each state.
+    
+    Guards are indexed as self.guards[state][player][action]. An action 
+    without a guard is always available.
     """
-    def __init__(self, transitions, payoffs, guards=None, init=0, config=None):
-        
-        ConcurrentGameModel.__init__(self, transitions, init)
-        self.games = [ Game(mat) for mat in payoffs ]
+    def __init__(self, transitions, payoffs, guards=None, init=0, config=None,
+                    validate=True, history=None):
         """
-        for i in range(len(payoffs)):
-            if self.games[i].shape[:-1] != transitions[i]:
-                raise ValueError()
-            if self.games[i].players != transitions[i].ndim:
-                raise ValueError()
+        Initialize a GCGMP.
+        
+        Keyword arguments
+        transitions -- a list of transition matrices
+        payoffs -- a list of payoff matrices, one for each state
+        guards -- a list of Guard objects (default None)
+        init -- the initial state (default 0)
+        config -- the initial configuration (default zeros)
+        validate -- check the transitions as for ConcurrentGameModel, and 
+        that the payoff matrices match them (default True)
+        history -- the PlayHistory recording plays, with payoffs and 
+        configurations (default one keeping every step)
         """
-        self.phistory = []
-        if guards == None:
-            self.guards = {}
         
-        if config == None:
+        ConcurrentGameModel.__init__(self, transitions, init, False, history)
+        self.games = [ Game(mat) for mat in payoffs ]
+        if validate:
+            self.validate()
+        
+        if config is None:
             self.config = np.zeros(self.players)
         else:
-            self.config = np.array(config)
+            self.config = np.array(config, dtype='float64')
         
-    def move(self,move):
-        self.phistory.append( self.games[self.cstate].outcome(move) )
-        self.config += self.games[self.cstate].outcome(move)
-        ConcurrentGameModel.move(self,move)
+        self.set_guards([] if guards is None else guards)
+        
+    def set_guards(self, guards):
+        """
+        Index a list of Guard objects by state, player and action, and 
+        precompute the default availability masks, in which every action 
+        is available.
+        """
+        self.guards = [ [ {} for _ in range(self.players) ] 
+                            for _ in self.states ]
+        self.guard_list = list(guards)
+        for guard in self.guard_list:
+            if guard.action in self.guards[guard.state][guard.player]:
+                raise ValueError("Only one guard per action is allowed.")
+            self.guards[guard.state][guard.player][guard.action] = guard
         
-    def reset(self,init=0):
-        self.phistory = []
-        ConcurrentGameModel.reset(self,init)
+        self.masks = [ [ np.ones(n, dtype=bool) 
+                            for n in np.shape(self.transitions[state]) ] 
+                            for state in self.states ]
+        self.guarded_states = np.unique(np.array(
+                [ g.state for g in self.guard_list ], dtype=np.intp))
+        
+        shapes = _shapes(self.transitions, None)
+        self.padded_masks = [ np.arange(n) < shapes[:, i, None] 
+                                for i, n in enumerate(shapes.max(axis=0)) ]
+        
+        # Guard values at the current configuration are kept up to date 
+        # incrementally as the configuration moves.
+        self._evaluator = IncrementalEvaluator(
+                [ g.formula for g in self.guard_list ], self.config)
+        self._index = { id(g) : j for j, g in enumerate(self.guard_list) }
+        
+    @property
+    def config(self):
+        """The current configuration. Assigning it also resets the guard 
+        values, which are otherwise only updated by move."""
+        return self._config
+    
+    @config.setter
+    def config(self, config):
+        self._config = np.array(config, dtype='float64')
+        if getattr(self, '_evaluator', None) is not None:
+            self._evaluator.reset(self._config)
+    
+    def _guard_value(self, guard):
+        """Returns the value of a guard at the current configuration."""
+        if self._evaluator is None:
+            return guard(self._config)
+        # The configuration may have been changed in place
+        if not np.array_equal(self._evaluator.x, self._config):
+            self._evaluator.reset(self._config)
+        return self._evaluator[self._index[id(guard)]]
+    
+    def available(self, state=None, config=None):
+        """
+        Returns a list with a boolean mask over the actions of each player,
+        marking the actions that are available. In states without guards 
+        the precomputed default masks are returned, and must not be modified.
+        
+        Keyword arguments
+        state -- the state (default the current state)
+        config -- the configuration (default the current configuration)
+        """
+        if state is None:
+            state = self.cstate
+        masks = self.masks[state]
+        if not any(self.guards[state]):
+            return masks
+        
+        masks = [ m.copy() for m in masks ]
+        for player in range(self.players):
+            for action, guard in self.guards[state][player].items():
+                if config is None:
+                    masks[player][action] = self._guard_value(guard)
+                else:
+                    masks[player][action] = guard(config)
+        return masks
+    
+    def available_batch(self, states, configs):
+        """
+        Returns a list with one boolean ndarray of shape (M, n_max) for each
+        player, marking the available actions for each of M pairs of states 
+        and configurations. Entries beyond the number of actions of a state 
+        are False.
+        
+        Keyword arguments
+        states -- an integer ndarray of shape (M,)
+        configs -- an ndarray of shape (M, players)
+        """
+        states = np.asarray(states, dtype=np.intp)
+        configs = np.asarray(configs, dtype='float64')
+        masks = [ m[states] for m in self.padded_masks ]
+        present = np.intersect1d(self.guarded_states, states)
+        for state in present:
+            rows = np.flatnonzero(states == state)
+            for player in range(self.players):
+                for action, guard in self.guards[state][player].items():
+                    masks[player][rows, action] = guard.batch(configs[rows])
+        return masks
+        
+    def move(self,move):
+        self.checkMove(move)
+        payoff = self.games[self.cstate].outcome(move)
+        self._config += payoff
+        if self._evaluator is not None:
+            self._evaluator.update(payoff)
+        self.history.append(self.cstate, move, payoff, self.config)
+        self.cstate = self.transitions[self.cstate][move]
+    
+    def reset(self, init=0, config=None):
+        """Moves the play back to state init, and to configuration config 
+        if it is given, and clears the history."""
+        ConcurrentGameModel.reset(self, init)
+        if config is not None:
+            self.config = config
+    
+    @property
+    def phistory(self):
+        """The payoffs of the play, as an ndarray of shape 
+        (steps, players)."""
+        return self.history.payoffs()
         
     def __str__(self):
         txt = ConcurrentGameModel.__str__(self)
@@ -135,12 +349,390 @@ class GuardedConcurrentGameModelPayoffs(ConcurrentGameModel):
         return txt
     
     def checkMove(self, move):
-        for i in range(players):
-            if move[i] in self.guards[self.cstate][i].keys():
-                check.append(self.guards[self.cstate][i][move[i]](self.config))
+        """Raises a ValueError if the move is not available in the current 
+        state and configuration."""
+        for i in range(self.players):
+            guard = self.guards[self.cstate][i].get(move[i])
+            if guard is not None and not self._guard_value(guard):
+                raise ValueError("The move is not available.")
+    
+    def pruned(self, lower, upper, integral=False):
+        """
+        Returns a copy of the model without the actions whose guards can 
+        never hold and without the guards that always hold, as decided by 
+        classify within bounds on the configurations. Also returns the 
+        original index of each remaining action, as a list of ndarrays 
+        indexed by state and player. If no action of a player in a state 
+        can be taken, the actions of that player are all kept.
+        
+        Keyword arguments
+        lower -- the lowest configuration, or an ndarray of shape 
+        (states, players) with the lowest configuration of each state, such
+        as the boxes of reachable_regions
+        upper -- the highest configuration, as for lower
+        integral -- whether all configurations are integral (default False)
+        """
+        shape = (len(self.states), self.players)
+        lower = np.broadcast_to(np.asarray(lower, dtype='float64'), shape)
+        upper = np.broadcast_to(np.asarray(upper, dtype='float64'), shape)
+        
+        transitions = []
+        payoffs = []
+        guards = []
+        kept = []
+        for state in range(len(self.states)):
+            values = [ {} for _ in range(self.players) ]
+            low, high = lower[state], upper[state]
+            if integral:
+                low, high = np.ceil(low), np.floor(high)
+            # Guards are not classified on boxes without a configuration
+            if np.all(low <= high):
+                for player in range(self.players):
+                    for action, guard in self.guards[state][player].items():
+                        values[player][action] = classify(guard.formula, 
+                                low, high, integral)
+            
+            actions = []
+            for player, n in enumerate(np.shape(self.transitions[state])):
+                alive = np.array([ values[player].get(a) is not False 
+                                    for a in range(n) ])
+                actions.append(np.flatnonzero(alive) if np.any(alive) 
+                                else np.arange(n))
+            index = np.ix_(*actions)
+            transitions.append(np.asarray(self.transitions[state])[index])
+            payoffs.append(self.games[state].mat[index])
+            kept.append(actions)
+            
+            for player in range(self.players):
+                position = { int(a) : i for i, a in enumerate(actions[player]) }
+                for action, guard in self.guards[state][player].items():
+                    if action in position and \
+                            values[player].get(action) is not True:
+                        guards.append(Guard(state, player, position[action], 
+                                            guard.formula))
+        
+        model = GuardedConcurrentGameModelPayoffs(transitions, payoffs, guards,
+                    self.cstate, self.config, validate=False)
+        return model, kept
+
+#################
+# PACKED MODELS #
+#################
+
+def _shapes(transitions, payoffs):
+    """Returns the shapes of the transition matrices as an ndarray of shape 
+    (states, players), checking that dimensions match, and that the payoff 
+    matrices have the shapes of the transitions plus a payoff axis."""
+    dims = np.array([ np.ndim(t) for t in transitions ])
+    if np.any(dims != dims[0]):
+        raise ValueError("Dimensions of transition matrices must match.")
+    shapes = np.array([ np.shape(t) for t in transitions ], 
+                        dtype=np.intp).reshape(len(transitions), dims[0])
+    
+    if payoffs is not None:
+        if len(payoffs) != len(transitions):
+            raise ValueError("Number of payoff matrices must match number "
+                    + "of states.")
+        pdims = np.array([ np.ndim(p) for p in payoffs ])
+        if np.any(pdims != dims[0]+1):
+            raise ValueError("Payoff matrices must have one axis more than "
+                    + "transition matrices.")
+        pshapes = np.array([ np.shape(p) for p in payoffs ], dtype=np.intp)
+        if np.any(pshapes[:, :-1] != shapes) or \
+                np.any(pshapes[:, -1] != dims[0]):
+            raise ValueError("Payoff matrices must match transitions.")
+    return shapes
+
+class PackedModel:
+    """
+    A CGM, or a GCGMP, with the transitions of all states in one padded 
+    integer ndarray of shape (states, n_1, ..., n_m), where n_i is the 
+    largest number of actions of player i in any state, and the payoffs in 
+    one padded ndarray of shape (states, n_1, ..., n_m, m). Padded 
+    transitions are -1 and padded payoffs 0. 
+    """
+    def __init__(self, transitions, payoffs=None):
+        self.shapes = _shapes(transitions, payoffs)
+        self.states = len(transitions)
+        self.players = self.shapes.shape[1]
+        self.actions = tuple(int(n) for n in self.shapes.max(axis=0))
         
-        if any(check) is False:
+        self.transitions = np.full((self.states,) + self.actions, -1, 
+                                    dtype=np.intp)
+        self.payoffs = None
+        if payoffs is not None:
+            self.payoffs = np.zeros((self.states,) + self.actions 
+                                        + (self.players,))
+        for state in range(self.states):
+            index = (state,) + tuple(slice(0, n) for n in self.shapes[state])
+            self.transitions[index] = transitions[state]
+            if payoffs is not None:
+                self.payoffs[index] = payoffs[state]
+    
+    def masks(self):
+        """Returns, for each player, a boolean ndarray of shape 
+        (states, n_i) marking the actions that exist in each state."""
+        return [ np.arange(n) < self.shapes[:, i, None] 
+                    for i, n in enumerate(self.actions) ]
+    
+    def valid(self):
+        """Returns a boolean ndarray with the shape of transitions, marking 
+        the joint actions that exist."""
+        valid = np.ones(self.transitions.shape, dtype=bool)
+        for i, mask in enumerate(self.masks()):
+            shape = [1] * (self.players+1)
+            shape[0] = self.states
+            shape[i+1] = self.actions[i]
+            valid &= mask.reshape(shape)
+        return valid
+    
+    def validate(self):
+        """Raises a ValueError if a transition does not point to a state."""
+        targets = self.transitions[self.valid()]
+        if np.any((targets < 0) | (targets >= self.states)):
+            raise ValueError("All transitions must be to other states.")
+    
+    def step(self, states, moves):
+        """Returns the targets and payoffs of joint moves, an integer 
+        ndarray of shape (N, players), made in an ndarray of states."""
+        index = (np.asarray(states),) + tuple(np.asarray(moves).T)
+        targets = self.transitions[index]
+        if np.any(targets < 0):
             raise ValueError("The move is not available.")
+        if self.payoffs is None:
+            return targets, None
+        return targets, self.payoffs[index]
+
+class RaggedModel:
+    """
+    A CGM, or a GCGMP, with the flattened transitions of all states 
+    concatenated into one integer ndarray, and the payoffs into one ndarray 
+    of shape (joint actions, m). The joint actions of state s are stored 
+    from offsets[s], in C order with the strides strides[s]. This is compact 
+    also when states have very different numbers of actions.
+    """
+    def __init__(self, transitions, payoffs=None):
+        shapes = _shapes(transitions, payoffs)
+        flat = np.concatenate([ np.ravel(t) for t in transitions ]
+                                ).astype(np.intp)
+        if payoffs is not None:
+            payoffs = np.concatenate([ np.reshape(p, (-1, shapes.shape[1])) 
+                                        for p in payoffs ]).astype('float64')
+        self._set(shapes, flat, payoffs)
+    
+    @classmethod
+    def from_arrays(cls, shapes, transitions, payoffs=None):
+        """Returns a RaggedModel on existing flat arrays, which are not 
+        copied."""
+        model = cls.__new__(cls)
+        model._set(np.asarray(shapes, dtype=np.intp), transitions, payoffs)
+        return model
+    
+    def _set(self, shapes, transitions, payoffs):
+        self.shapes = shapes
+        self.states = shapes.shape[0]
+        self.players = shapes.shape[1]
+        
+        sizes = np.prod(self.shapes, axis=1)
+        self.offsets = np.zeros(self.states+1, dtype=np.intp)
+        self.offsets[1:] = np.cumsum(sizes)
+        self.strides = np.ones_like(self.shapes)
+        self.strides[:, :-1] = np.cumprod(self.shapes[:, :0:-1], 
+                                            axis=1)[:, ::-1]
+        self.transitions = transitions
+        self.payoffs = payoffs
+    
+    def index(self, states, moves):
+        """Returns the flat indices of joint moves made in an ndarray of 
+        states."""
+        states = np.asarray(states, dtype=np.intp)
+        moves = np.asarray(moves, dtype=np.intp)
+        if np.any((moves < 0) | (moves >= self.shapes[states])):
+            raise ValueError("The move is not available.")
+        return self.offsets[states] + np.sum(moves*self.strides[states], 
+                                                axis=-1)
+    
+    def validate(self):
+        """Raises a ValueError if a transition does not point to a state."""
+        if np.any((self.transitions < 0) | 
+                    (self.transitions >= self.states)):
+            raise ValueError("All transitions must be to other states.")
+    
+    def step(self, states, moves):
+        """Returns the targets and payoffs of joint moves, as for 
+        PackedModel."""
+        index = self.index(states, moves)
+        if self.payoffs is None:
+            return self.transitions[index], None
+        return self.transitions[index], self.payoffs[index]
+
+###############
+# LAZY MODELS #
+###############
+
+class LazyModel(GuardedConcurrentGameModelPayoffs):
+    """
+    A model whose states are generated by a callback when they are first 
+    reached. Generated states are kept in a least recently used cache of 
+    bounded size, and are generated again if they are needed after being 
+    evicted, so the callback must be deterministic.
+    
+    The callback takes a state and returns a pair (targets, payoffs), where 
+    payoffs is a payoff matrix of shape (n_1, ..., n_m, m) and targets is a 
+    nested sequence of the same shape (n_1, ..., n_m), with the successor of
+    each joint action. If intern is True, states may be any hashable 
+    objects, and are interned to integer ids 0, 1, ... in the order they 
+    are found, the initial state receiving id 0. Otherwise states are 
+    integers, and are used as ids directly.
+    
+    The model supports move and reset as any GCGMP, with ids as states. 
+    Functions over all states, such as transition_matrix, apply to the 
+    states found so far, so the reachable states should first be found with
+    explore. Guards are not supported.
+    """
+    def __init__(self, expand, init=0, intern=False, cache_size=None, 
+                    config=None):
+        """
+        Initialize a lazy model.
+        
+        Keyword arguments
+        expand -- the callback generating a state
+        init -- the initial state (default 0)
+        intern -- whether to intern states to integer ids (default False)
+        cache_size -- the largest number of generated states kept, or None 
+        for no limit (default None)
+        config -- the initial configuration (default zeros)
+        """
+        self.expand = expand
+        self.intern = intern
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.ids = {}
+        self.keys = []
+        self.known = 0
+        
+        self.init = self.id(init)
+        self.cstate = self.init
+        self.transitions = _LazyStates(self, 0)
+        self.games = _LazyStates(self, 1)
+        self.players = self.games[self.cstate].players
+        self.history = PlayHistory(self.players)
+        
+        if config is None:
+            self.config = np.zeros(self.players)
+        else:
+            self.config = np.array(config, dtype='float64')
+        
+        self.guard_list = []
+        self.guards = _NoGuards(self.players)
+        self.masks = _LazyMasks(self)
+        self._evaluator = None
+    
+    @property
+    def states(self):
+        return range(self.known)
+    
+    def id(self, state):
+        """Returns the id of a state, interning it if needed."""
+        if not self.intern:
+            self.known = max(self.known, state+1)
+            return state
+        if state not in self.ids:
+            self.ids[state] = len(self.keys)
+            self.keys.append(state)
+            self.known = len(self.keys)
+        return self.ids[state]
+    
+    def key(self, state):
+        """Returns the state with a given id."""
+        return self.keys[state] if self.intern else state
+    
+    def state(self, state):
+        """Returns the transition matrix of ids and the Game of a state, 
+        generating it if it is not in the cache."""
+        if state in self.cache:
+            self.cache.move_to_end(state)
+            return self.cache[state]
+        
+        targets, payoffs = self.expand(self.key(state))
+        game = Game(payoffs)
+        shape = game.shape[:-1]
+        flat = _flatten(targets, len(shape))
+        if len(flat) != int(np.prod(shape)):
+            raise ValueError("Transitions must match the payoff matrix.")
+        ids = np.array([ self.id(t) for t in flat ], 
+                        dtype=np.intp).reshape(shape)
+        
+        self.cache[state] = (ids, game)
+        if self.cache_size is not None and len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return self.cache[state]
+    
+    def explore(self, limit=None):
+        """
+        Generates every state reachable from the initial state by breadth 
+        first search, stopping early once at least limit states are known. 
+        Returns the number of known states.
+        """
+        frontier = deque([ self.init ])
+        seen = { self.init }
+        while frontier:
+            if limit is not None and self.known >= limit:
+                break
+            for target in np.unique(self.state(frontier.popleft())[0]):
+                if int(target) not in seen:
+                    seen.add(int(target))
+                    frontier.append(int(target))
+        return self.known
+    
+    def set_guards(self, guards):
+        raise TypeError("Guards are not supported by lazy models.")
+    
+    def validate(self):
+        pass
+
+class _LazyStates:
+    """The transition matrices (part 0) or games (part 1) of a LazyModel."""
+    def __init__(self, model, part):
+        self.model = model
+        self.part = part
+    
+    def __len__(self):
+        return self.model.known
+    
+    def __getitem__(self, state):
+        return self.model.state(state)[self.part]
+    
+    def __iter__(self):
+        return (self[s] for s in range(len(self)))
+
+class _LazyMasks(_LazyStates):
+    """The default availability masks of a LazyModel."""
+    def __init__(self, model):
+        _LazyStates.__init__(self, model, 0)
+    
+    def __getitem__(self, state):
+        return [ np.ones(n, dtype=bool) 
+                    for n in np.shape(self.model.state(state)[0]) ]
+
+class _NoGuards:
+    """An empty guard index over any number of states."""
+    def __init__(self, players):
+        self.empty = [ {} for _ in range(players) ]
+    
+    def __getitem__(self, state):
+        return self.empty
+
+def _flatten(targets, depth):
+    """Flattens a nested sequence of the given depth into a list, keeping 
+    the elements, which may themselves be sequences, intact."""
+    if depth == 0:
+        return [ targets ]
+    flat = []
+    for t in targets:
+        flat.extend(_flatten(t, depth-1))
+    return flat
+
 ##############
 # STRATEGIES #
 ##############
@@ -150,25 +742,41 @@ class MixedStrategy:
     MixedStrategy
     
     Represents a mixed strategy as a n-dimensional ndarray with non-negative 
-    entries that sum to 1.
+    entries that sum to 1. Outcomes are sampled in constant time from a 
+    Walker alias table, which is built on first use.
     """
     def __init__(self, dist):
         self.dist = np.array(dist)
         
-        for v in self.dist:
-            if v < 0:
-                raise ValueError("Entries must be non-negative.")
+        if np.any(self.dist < 0):
+            raise ValueError("Entries must be non-negative.")
         
         self.cumm = np.zeros(len(self.dist)+1)
-        for index in range(len(self.cumm)-1):
-            self.cumm[index+1] = self.cumm[index]+self.dist[index]
+        self.cumm[1:] = np.cumsum(self.dist)
         self.cumm[-1] = 1.0
+        self.alias = None
             
-    def __call__(self):
-        """Returns an outcome from the mixed strategy"""
+    def __call__(self, rng=None):
+        """Returns an outcome from the mixed strategy. If rng is given, the
+        draw is taken from that numpy Generator instead of the global one."""
+        
+        return int(self.sample(None, rng))
+    
+    def sample(self, n=None, rng=None):
+        """
+        Returns an ndarray of n outcomes from the mixed strategy, or a single
+        outcome if n is None.
         
-        t = np.random.random()
-        return np.searchsorted(self.cumm, t)-1
+        A uniform draw u picks the column floor(u*len) of the alias table, 
+        and its fractional part decides between the column and its alias.
+        """
+        if self.alias is None:
+            self.prob, self.alias = alias_table(self.dist)
+        
+        t = (np.random.random(n) if rng is None else rng.random(n)) \
+                * len(self.dist)
+        i = np.minimum(np.floor(t).astype(np.intp), len(self.dist)-1)
+        return np.where(t - i < self.prob[i], i, self.alias[i])
             
     def __str__(self):
         return str(self.dist)
@@ -199,6 +807,30 @@ class MixedStateBasedStrategy:
         self.strategies = strategies
         self.states = len(strategies)
         self.cstate = 0
+        self.tables = None
+    
+    def sample(self, states, rng=None):
+        """
+        Returns an ndarray with one outcome for each entry of an array of 
+        states, from the strategy of that state. The alias tables of all 
+        states are packed into padded arrays on first use, so that all 
+        draws are made in one vectorized step.
+        """
+        if self.tables is None:
+            sizes = np.array([ len(s) for s in self.strategies ])
+            prob = np.ones((self.states, sizes.max()))
+            alias = np.zeros((self.states, sizes.max()), dtype=np.intp)
+            for state, strategy in enumerate(self.strategies):
+                prob[state, :sizes[state]], alias[state, :sizes[state]] = \
+                    alias_table(strategy.dist)
+            self.tables = (sizes, prob, alias)
+        
+        sizes, prob, alias = self.tables
+        states = np.asarray(states, dtype=np.intp)
+        t = (np.random.random(states.shape) if rng is None 
+                else rng.random(states.shape)) * sizes[states]
+        i = np.minimum(np.floor(t).astype(np.intp), sizes[states]-1)
+        return np.where(t - i < prob[states, i], i, alias[states, i])
 
     def __getitem__(self,key):
         return self.strategies[key]
@@ -228,9 +860,186 @@ class Guard():
         self.player = player
         self.action = action
         self.formula = formula
+        self.compiled = PAFormula(formula).compile()
         
     def __call__(self,x):
         return self.formula(x)
+    
+    def batch(self,X):
+        """Evaluates the guard at each row of X, returning a boolean ndarray"""
+        return self.compiled(X)
+
+#################
+# MARKOV CHAINS #
+#################
+
+class MarkovChainAnalysis:
+    """
+    A cached analysis of the Markov chain induced by a profile of state-based
+    mixed strategies on a CGM: the transition matrix, its strongly connected
+    components and the stationary distribution of each bottom component.
+    
+    When the strategy of one player in one state is replaced by update, only
+    that row of the transition matrix is recomputed. If its support is 
+    unchanged, the components stay the same and the stationary distribution 
+    of the component containing the state is corrected by a rank-one 
+    (Sherman-Morrison) update of its cached factorization. Otherwise the 
+    components are recomputed, and stationary distributions are reused for 
+    every bottom component that is unchanged and does not contain the state.
+    """
+    def __init__(self, cgm, profile):
+        if cgm.players != len(profile):
+            raise ValueError("Number of strategy profiles must match number "
+                    + "of players in CGM.")
+        if any(len(cgm.states) != s.states for s in profile):
+            raise ValueError("Number of states in strategy profile must "
+                    + "match number of states in CGM.")
+        
+        self.cgm = cgm
+        self.profile = [ MixedStateBasedStrategy(list(s.strategies)) 
+                            for s in profile ]
+        self.rows = [ self._row(state) for state in cgm.states ]
+        if hasattr(cgm, 'games'):
+            self.rewards = np.array([ self._reward(state) 
+                                        for state in cgm.states ])
+        else:
+            self.rewards = None
+        
+        self.components = {}
+        self._rebuild(None)
+    
+    def _row(self, state):
+        """Returns the sorted successors of a state and their 
+        probabilities."""
+        dist = expected_outcome([ p[state] for p in self.profile ])
+        targets = np.asarray(self.cgm.transitions[state]).ravel()
+        cols, inverse = np.unique(targets, return_inverse=True)
+        probs = np.bincount(inverse.ravel(), weights=dist.ravel())
+        keep = probs > 0
+        return cols[keep], probs[keep]
+    
+    def _reward(self, state):
+        return self.cgm.games[state].expected_outcome(
+                    [ p[state] for p in self.profile ])
+    
+    def _rebuild(self, changed):
+        """Rebuilds the matrix and components, reusing the cached 
+        stationary distributions of bottom components that do not contain 
+        the changed state."""
+        n = len(self.rows)
+        lengths = [ len(r[0]) for r in self.rows ]
+        indptr = np.zeros(n+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        indices = np.concatenate([ r[0] for r in self.rows ])
+        data = np.concatenate([ r[1] for r in self.rows ])
+        self.matrix = sp.csr_matrix((data, indices, indptr), shape=(n, n))
+        
+        self.n, self.labels, self.bottom = bottom_components(self.matrix)
+        components = {}
+        for c in np.flatnonzero(self.bottom):
+            members = np.flatnonzero(self.labels == c)
+            key = members.tobytes()
+            if key in self.components and (changed is None or 
+                    changed not in self.components[key].position):
+                components[key] = self.components[key]
+            else:
+                components[key] = _Component(self.matrix, members)
+        self.components = components
+    
+    def update(self, state, player, strategy):
+        """
+        Replaces the MixedStrategy of a player in a state and updates the 
+        analysis.
+        """
+        if type(strategy) is not MixedStrategy:
+            raise TypeError("Strategy must be a MixedStrategy.")
+        
+        strategies = list(self.profile[player].strategies)
+        strategies[state] = strategy
+        self.profile[player] = MixedStateBasedStrategy(strategies)
+        if self.rewards is not None:
+            self.rewards[state] = self._reward(state)
+        
+        old_cols, old_probs = self.rows[state]
+        cols, probs = self._row(state)
+        self.rows[state] = (cols, probs)
+        
+        if not np.array_equal(cols, old_cols):
+            self._rebuild(state)
+            return
+        
+        start = self.matrix.indptr[state]
+        self.matrix.data[start:start+len(probs)] = probs
+        if self.bottom[self.labels[state]]:
+            members = np.flatnonzero(self.labels == self.labels[state])
+            self.components[members.tobytes()].update(self.matrix, state, 
+                                                cols, probs - old_probs)
+    
+    def stationary(self):
+        """Returns a list of pairs of the states of each bottom component 
+        and their stationary distribution."""
+        return [ (c.members, c.pi) for c in self.components.values() ]
+    
+    def expected_outcome(self, init=None):
+        """Returns the expected long-run average payoff from a state 
+        (default the current state of the model)."""
+        if self.rewards is None:
+            raise TypeError("Expected outcomes require a model with payoffs.")
+        if init is None:
+            init = self.cgm.cstate
+        
+        values = np.zeros((self.n, self.rewards.shape[1]))
+        for c in self.components.values():
+            values[self.labels[c.members[0]]] = c.pi @ self.rewards[c.members]
+        return absorbed_value(self.matrix, init, self.labels, self.bottom, 
+                                values)
+
+class _Component:
+    """
+    A bottom component with a factorization of M = P^T - I, with the last 
+    row replaced by ones, and a list of rank-one updates of M.
+    """
+    refactor = 32
+    
+    def __init__(self, matrix, members):
+        self.members = members
+        self.position = { int(s) : i for i, s in enumerate(members) }
+        self._factor(matrix)
+    
+    def _factor(self, matrix):
+        n = len(self.members)
+        m = (matrix[self.members][:, self.members].T - 
+                sp.identity(n)).tolil()
+        m[n-1, :] = np.ones(n)
+        self.lu = spla.splu(m.tocsc())
+        self.updates = []
+        b = np.zeros(n)
+        b[-1] = 1.0
+        self.pi = self.solve(b)
+    
+    def solve(self, b):
+        y = self.lu.solve(b)
+        for j, z, denom in self.updates:
+            y = y - z*(y[j]/denom)
+        return y
+    
+    def update(self, matrix, state, cols, delta):
+        """Applies a change delta of the transition probabilities from 
+        state to the states cols. The matrix is refactored, from the 
+        already updated transition matrix, after too many updates or when 
+        the update is ill-conditioned."""
+        j = self.position[state]
+        u = np.zeros(len(self.members))
+        u[[ self.position[int(c)] for c in cols ]] = delta
+        u[-1] = 0.0
+        z = self.solve(u)
+        denom = 1.0 + z[j]
+        if len(self.updates) >= self.refactor or abs(denom) < 1e-12:
+            self._factor(matrix)
+            return
+        self.updates.append((j, z, denom))
+        self.pi = self.pi - z*(self.pi[j]/denom)
+
 #############
 # FUNCTIONS #
 #############
@@ -246,59 +1055,157 @@ def expected_outcome(profile):
     
     return outcome
       
+def alias_table(dist):
+    """Returns the probability and alias arrays of the Walker alias table of 
+    a distribution, built with Vose's method."""
+    n = len(dist)
+    scaled = np.asarray(dist, dtype='float64') * n / np.sum(dist)
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [ i for i in range(n) if scaled[i] < 1 ]
+    large = [ i for i in range(n) if scaled[i] >= 1 ]
+    
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] += scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    
+    return prob, alias
+
 def transition_matrix(cgm, profile):
-    """Returns the transition matrix for a given CGM and strategy profile."""
+    """Returns the transition matrix for a given CGM and strategy profile, 
+    as a scipy.sparse CSR matrix."""
     if cgm.players != len(profile):
         raise ValueError("Number of strategy profiles must match number of "
                 + "players in CGM.")
     
-    if any(cgm.states != s.states for s in profile):
+    states = len(cgm.states)
+    if any(states != s.states for s in profile):
         raise ValueError("Number of states in strategy profile must match "
                 + "number of states in CGM.")
     
-    # Extract state outcomes
-    temp = []
-    outcomes = []
-    for state in range(cgm.states):
-        for player in profile:
-            temp.append(player[state])
-        
-        outcomes.append(expected_outcome(temp))
-        temp = []
-    
+    # Collect the probability and target of every joint action
+    rows = []
+    cols = []
+    probs = []
+    for state in range(states):
+        dist = expected_outcome([ player[state] for player in profile ])
+        targets = np.asarray(cgm.transitions[state])
+        rows.append(np.full(targets.size, state, dtype=np.int64))
+        cols.append(targets.ravel())
+        probs.append(dist.ravel())
     
-    # Calculate transition probabilities
-    transition = np.zeros((cgm.states,cgm.states))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols).astype(np.int64)
+    probs = np.concatenate(probs)
     
-    for state in range(len(cgm.states)):
-        for prob, end_state in np.nditer( [outcomes[state],
-                cgm.transitions[state]]):
-            transitions[state,end_state] += prob
+    # Accumulate joint actions leading to the same target
+    keys, inverse = np.unique(rows*states + cols, return_inverse=True)
+    weights = np.bincount(inverse.ravel(), weights=probs)
+    keep = weights > 0
+    keys = keys[keep]
     
-    return transitions
+    return sp.csr_matrix((weights[keep], (keys // states, keys % states)), 
+                            shape=(states, states))
 
 def markov_chain(cgm, profile):
     """ Returns the Markov chain corresponding to a state-based mixed 
     strategy profile """
     t = transition_matrix(cgm, profile)
+    return nx.from_scipy_sparse_array(t, create_using=nx.DiGraph)
+
+def bottom_components(t):
+    """Returns the strongly connected components of a transition matrix,
+    as the number of components and a label for each state, together with
+    a boolean array marking the bottom (attracting) components, which have
+    no transitions leaving them."""
+    n, labels = connected_components(t, directed=True, connection='strong')
+    t = t.tocoo()
+    leaving = labels[t.row] != labels[t.col]
+    bottom = np.ones(n, dtype=bool)
+    bottom[labels[t.row[leaving]]] = False
+    return n, labels, bottom
 
-    G = nx.DiGraph()
+def stationary_distribution(t):
+    """Returns the stationary distribution of an irreducible transition 
+    matrix, by a sparse solve of pi (t - I) = 0 with one equation replaced 
+    by sum(pi) = 1."""
+    n = t.shape[0]
+    if n == 1:
+        return np.ones(1)
+    a = (t.T - sp.identity(n)).tolil()
+    a[n-1, :] = np.ones(n)
+    b = np.zeros(n)
+    b[n-1] = 1.0
+    return spla.spsolve(a.tocsc(), b)
+
+def absorbed_value(t, init, labels, bottom, values):
+    """Returns the expected value from a state of a Markov chain that is 
+    eventually absorbed into a bottom component, given the value of each 
+    bottom component. The absorption probabilities are found by a sparse 
+    solve of (I - Q) h = R v over the transient states reachable from the 
+    state, where Q and R are the transitions to transient and to recurrent 
+    states.
     
-    for i in range(x.shape[0]):
-        for j in range(x.shape[1]):
-            if x[i,j] > 0:
-                G.add_edge(i,j)
-                G[i][j]['weight']=x[i,j]
+    Keyword arguments
+    t -- the transition matrix, as a scipy.sparse matrix
+    init -- the initial state
+    labels -- the strongly connected component of each state
+    bottom -- a boolean array marking the bottom components
+    values -- the value of each component, indexed by label
+    """
+    if bottom[labels[init]]:
+        return values[labels[init]]
     
-    return G
+    reach = np.sort(breadth_first_order(t, init, directed=True, 
+                                            return_predecessors=False))
+    recurrent = bottom[labels[reach]]
+    transient = reach[~recurrent]
+    recurrent = reach[recurrent]
+    t = t.tocsr()
+    a = sp.identity(len(transient), format='csc') - \
+            t[transient][:, transient].tocsc()
+    b = t[transient][:, recurrent] @ values[labels[recurrent]]
+    h = spla.splu(a).solve(np.asarray(b))
+    return h[int(np.searchsorted(transient, init))]
 
 def expected_outcome_statebased(cgm, profile):
     """Outputs the expected value of a profile of state-based 
-    mixed strategies."""
-    # TODO: Find attracting, irreducible subchains
-    # TODO: Calculate expected value 
-    chain = markov_chain(cgm,profile)
-    connected_components = nx.algorithms.strongly_connected_components(chain)
+    mixed strategies, i.e. the expected long-run average payoff of a play 
+    from the current state of a GCGMP.
+    
+    The play is eventually absorbed into a bottom strongly connected 
+    component of the induced Markov chain, where the average payoff is the 
+    stage payoff averaged over the component's stationary distribution. 
+    These values are weighted by the absorption probabilities from the 
+    initial state."""
+    t = transition_matrix(cgm, profile)
+    init = cgm.cstate
+    
+    # Restrict to the states reachable from the initial state
+    reach = np.sort(breadth_first_order(t, init, directed=True, 
+                                            return_predecessors=False))
+    t = t[reach][:, reach].tocsr()
+    start = int(np.searchsorted(reach, init))
+    
+    rewards = np.array([ cgm.games[s].expected_outcome(
+                            [ player[s] for player in profile ]) 
+                            for s in reach ])
+    
+    n, labels, bottom = bottom_components(t)
+    values = np.zeros((n, cgm.players))
+    for c in np.flatnonzero(bottom):
+        members = np.flatnonzero(labels == c)
+        pi = stationary_distribution(t[members][:, members])
+        values[c] = pi @ rewards[members]
+    
+    return absorbed_value(t, start, labels, bottom, values)
        
 def all_equal(iterable):
     """Returns True if all the elements are equal to each other"""
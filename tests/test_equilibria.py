@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from games import GuardedConcurrentGameModelPayoffs
+from Equilibria import value_iteration
+
+def cycle_model():
+    # Two states visited in turn, paying 1 and then 0
+    transitions = [ np.array([[1]]), np.array([[0]]) ]
+    payoffs = [ np.array([[[1.0, -1.0]]]), np.array([[[0.0, 0.0]]]) ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs)
+
+def random_model(states, seed):
+    rng = np.random.default_rng(seed)
+    transitions = [ rng.integers(0, states, (2, 2)) for _ in range(states) ]
+    payoffs = [ rng.normal(size=(2, 2, 2)) for _ in range(states) ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs)
+
+@pytest.mark.parametrize('max_iter', [ 1000, 1001 ])
+def test_mean_payoff_of_periodic_model(max_iter):
+    gains, profile = value_iteration(cycle_model(), max_iter=max_iter)
+    assert np.allclose(gains, 0.5)
+
+def test_mean_payoff_is_discounted_limit():
+    model = random_model(3, 0)
+    gains, profile = value_iteration(model)
+    values, profile = value_iteration(model, discount=0.99)
+    assert np.allclose(gains, 0.01*values, atol=5e-3)
+
+def test_unconverged_iteration_raises():
+    with pytest.raises(ValueError):
+        value_iteration(random_model(3, 0), discount=0.99, max_iter=5)
+    with pytest.raises(ValueError):
+        value_iteration(cycle_model(), max_iter=1)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from games import Game, MixedStrategy
+
+def test_regret_with_one_batched_player():
+    rng = np.random.default_rng(0)
+    game = Game(rng.normal(size=(2, 3, 2)))
+    candidates = rng.dirichlet(np.ones(2), size=4)
+    other = MixedStrategy([1/3]*3)
+    regret = game.regret([candidates, other])
+    assert regret.shape == (4, 2)
+    for b in range(4):
+        assert np.allclose(regret[b], game.regret([candidates[b], other]))
+    payoffs = game.action_payoffs([candidates, other])
+    assert payoffs[0].shape == (4, 2) and payoffs[1].shape == (4, 3)
+    assert game.expected_outcome([candidates, other]).shape == (4, 2)
+
+def test_batched_opponent_only():
+    rng = np.random.default_rng(1)
+    game = Game(rng.normal(size=(2, 3, 2)))
+    mine = np.array([0.25, 0.75])
+    theirs = rng.dirichlet(np.ones(3), size=5)
+    best = game.best_responses([mine, theirs])
+    assert best[0].shape == (5, 2) and best[1].shape == (5, 3)
+    for b in range(5):
+        assert np.array_equal(best[0][b],
+                                game.best_responses([mine, theirs[b]])[0])
+
+def test_one_player_game():
+    game = Game(np.array([[1.0], [3.0], [2.0]]))
+    dists = np.array([[1.0, 0, 0], [0, 0.5, 0.5]])
+    assert np.allclose(game.regret([dists]), [[2.0], [0.5]])
+    assert np.allclose(game.regret([MixedStrategy([0, 1, 0])]), [0.0])
+    assert np.array_equal(game.best_responses([dists])[0],
+                            [[False, True, False]]*2)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from games import Guard, GuardedConcurrentGameModelPayoffs
+from PresburgerArithmetic import PAFormula, LinearConstraint, classify
+
+A = np.array([1, 0])
+GAPPED = PAFormula('|', [ LinearConstraint(A, 0, 0.2),
+                          LinearConstraint(A, 1.1, 2) ])
+
+def gapped_model(config):
+    transitions = [ np.array([[0]]) ]
+    payoffs = [ np.zeros((1, 1, 2)) ]
+    guards = [ Guard(0, 0, 0, GAPPED) ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs, guards,
+                                                config=config)
+
+def test_integral_simplification_keeps_gaps():
+    for x in range(-1, 4):
+        assert GAPPED.simplify(True)([x, 0]) == GAPPED([x, 0])
+
+def test_classify_gap_is_false():
+    assert classify(GAPPED, [1, 0], [1, 0], True) is False
+    assert classify(GAPPED, [0, 0], [2, 0], True) is None
+
+def test_pruned_keeps_blocked_move_blocked():
+    model, kept = gapped_model([1, 0]).pruned([0, 0], [2, 0], True)
+    with pytest.raises(ValueError):
+        model.move((0, 0))
+
+def test_pruned_box_without_integer_point():
+    model, kept = gapped_model([0, 0]).pruned([0.2, 0], [0.8, 0], True)
+    assert len(model.guard_list) == 1
+    assert [ list(a) for a in kept[0] ] == [ [0], [0] ]
+
+def threshold_model():
+    transitions = [ np.array([[0], [0]]) ]
+    payoffs = [ np.array([[[1.0, 0.0]], [[0.0, 0.0]]]) ]
+    guards = [ Guard(0, 0, 0, PAFormula(LinearConstraint([1, 0], -np.inf,
+                                                            2))) ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs, guards)
+
+def test_assigned_config_updates_guards():
+    model = threshold_model()
+    for _ in range(3):
+        model.move((0, 0))
+    assert not model.available()[0][0]
+    model.reset()
+    model.config = np.zeros(2)
+    model.move((0, 0))
+    model.reset(config=[5, 0])
+    assert not model.available()[0][0]
+
+def test_config_changed_in_place_updates_guards():
+    model = threshold_model()
+    model.config[0] = 5
+    with pytest.raises(ValueError):
+        model.move((0, 0))
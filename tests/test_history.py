@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from History import TrajectoryWriter, read_trajectory
+
+def write(path, steps, **kwargs):
+    with TrajectoryWriter(path, 2, chunk=4, **kwargs) as w:
+        for k in range(steps):
+            w.append(k, (k % 2, 1), np.ones(2), np.full(2, k))
+
+def test_append_continues_trajectory(tmp_path):
+    path = str(tmp_path / 'play.npy')
+    write(path, 6, state_dtype='int64')
+    write(path, 3, state_dtype='int16')
+    chunks = list(read_trajectory(path))
+    states = np.concatenate([ c[0] for c in chunks ])
+    assert list(states) == list(range(6)) + list(range(3))
+    assert all(c[0].dtype == np.int64 for c in chunks)
+
+def test_append_with_other_layout_fails(tmp_path):
+    path = str(tmp_path / 'play.npy')
+    write(path, 6)
+    with pytest.raises(ValueError):
+        TrajectoryWriter(path, 3)
+    with pytest.raises(ValueError):
+        TrajectoryWriter(path, 2, payoffs=False)
+    assert sum(len(c[0]) for c in read_trajectory(path)) == 6
@@ -0,0 +1,90 @@
+import numpy as np
+
+from games import (GuardedConcurrentGameModelPayoffs, MarkovChainAnalysis,
+                    MixedStateBasedStrategy, MixedStrategy,
+                    expected_outcome_statebased, transition_matrix)
+
+def absorbing_model(seed):
+    # States 0 and 1 are transient, 2 and 3 form a periodic bottom
+    # component, and 4 and 5 an aperiodic one
+    rng = np.random.default_rng(seed)
+    transitions = [ np.array([[1, 2], [4, 0]]), np.array([[0, 3], [5, 1]]),
+                    np.array([[3, 3], [3, 3]]), np.array([[2, 2], [2, 2]]),
+                    np.array([[4, 5], [5, 4]]), np.array([[4, 4], [5, 5]]) ]
+    payoffs = [ rng.normal(size=(2, 2, 2)) for _ in transitions ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs)
+
+def random_profile(rng, states=6):
+    return [ MixedStateBasedStrategy([ MixedStrategy(rng.dirichlet([1, 1]))
+                                        for _ in range(states) ])
+                for _ in range(2) ]
+
+def cesaro_outcome(model, profile, steps=20000):
+    # Long-run average payoff by averaging the distributions of a dense
+    # power iteration
+    t = transition_matrix(model, profile).toarray()
+    rewards = np.array([ model.games[s].expected_outcome(
+                            [ p[s] for p in profile ]) for s in model.states ])
+    dist = np.zeros(len(t))
+    dist[model.cstate] = 1.0
+    total = np.zeros(len(t))
+    for _ in range(steps):
+        total += dist
+        dist = dist @ t
+    return total / steps @ rewards
+
+def assert_same_analysis(analysis, fresh):
+    assert np.allclose(analysis.matrix.toarray(), fresh.matrix.toarray())
+    pis = { m.tobytes() : pi for m, pi in fresh.stationary() }
+    assert len(pis) == len(analysis.stationary())
+    for members, pi in analysis.stationary():
+        assert np.allclose(pi, pis[members.tobytes()])
+    for init in analysis.cgm.states:
+        assert np.allclose(analysis.expected_outcome(init),
+                            fresh.expected_outcome(init))
+
+def test_expected_outcome_matches_power_iteration():
+    rng = np.random.default_rng(0)
+    for seed in range(3):
+        model = absorbing_model(seed)
+        profile = random_profile(rng)
+        for init in (0, 1, 2, 4):
+            model.cstate = init
+            expected = cesaro_outcome(model, profile)
+            assert np.allclose(expected_outcome_statebased(model, profile),
+                                expected, atol=1e-3)
+            analysis = MarkovChainAnalysis(model, profile)
+            assert np.allclose(analysis.expected_outcome(), expected,
+                                atol=1e-3)
+
+def test_update_with_unchanged_support():
+    rng = np.random.default_rng(1)
+    model = absorbing_model(1)
+    profile = random_profile(rng)
+    analysis = MarkovChainAnalysis(model, profile)
+    # More updates than the component refactors after
+    for _ in range(40):
+        state = int(rng.integers(6))
+        player = int(rng.integers(2))
+        strategy = MixedStrategy(rng.dirichlet([1, 1]))
+        analysis.update(state, player, strategy)
+        strategies = list(profile[player].strategies)
+        strategies[state] = strategy
+        profile[player] = MixedStateBasedStrategy(strategies)
+    assert_same_analysis(analysis, MarkovChainAnalysis(model, profile))
+
+def test_update_with_changed_support():
+    rng = np.random.default_rng(2)
+    model = absorbing_model(2)
+    profile = random_profile(rng)
+    analysis = MarkovChainAnalysis(model, profile)
+    # Cut and restore transitions, between and within the bottom components
+    for state, player, dist in [ (4, 1, [1, 0]), (0, 0, [0, 1]),
+                                 (1, 1, [1, 0]), (4, 1, [0.5, 0.5]),
+                                 (0, 0, [0.3, 0.7]), (5, 0, [0, 1]) ]:
+        strategy = MixedStrategy(dist)
+        analysis.update(state, player, strategy)
+        strategies = list(profile[player].strategies)
+        strategies[state] = strategy
+        profile[player] = MixedStateBasedStrategy(strategies)
+        assert_same_analysis(analysis, MarkovChainAnalysis(model, profile))
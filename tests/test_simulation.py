@@ -0,0 +1,57 @@
+import pickle
+import tracemalloc
+
+import numpy as np
+
+from games import GuardedConcurrentGameModelPayoffs, MixedStrategy, \
+                    MixedStateBasedStrategy
+from Simulation import BatchedPlays, _simulate_chunk, parallel_run
+from Storage import share_model
+
+def random_model(states, actions, seed=0):
+    rng = np.random.default_rng(seed)
+    transitions = [ rng.integers(0, states, (actions, actions))
+                        for _ in range(states) ]
+    payoffs = [ rng.normal(size=(actions, actions, 2))
+                    for _ in range(states) ]
+    return GuardedConcurrentGameModelPayoffs(transitions, payoffs)
+
+def uniform_profile(states, actions):
+    return [ MixedStateBasedStrategy([ MixedStrategy(np.full(actions,
+                    1/actions)) for _ in range(states) ]) for _ in range(2) ]
+
+def test_shared_worker_does_not_copy_model():
+    states, actions = 3000, 12
+    model = random_model(states, actions)
+    profile = uniform_profile(states, actions)
+    ragged = model.pack(ragged=True)
+    size = ragged.transitions.nbytes + ragged.payoffs.nbytes
+
+    with share_model(model) as shared:
+        # A worker receives the SharedModel pickled
+        worker = pickle.loads(pickle.dumps(shared))
+        tracemalloc.start()
+        _simulate_chunk(worker, profile, 100, 5, 0, 0, None)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        worker.close()
+    assert peak < size / 4
+
+def test_parallel_run_on_shared_model():
+    states, actions = 50, 3
+    model = random_model(states, actions)
+    profile = uniform_profile(states, actions)
+    with share_model(model) as shared:
+        stats = parallel_run(shared, profile, 40, 20, seed=1, workers=2)
+    direct = parallel_run(model, profile, 40, 20, seed=1, workers=2)
+    assert stats.plays == 40
+    assert np.allclose(stats.mean, direct.mean)
+
+def test_batched_move_matches_model():
+    model = random_model(20, 3)
+    batch = BatchedPlays(model, 1)
+    for move in [ (0, 1), (2, 2), (1, 0) ]:
+        batch.move(np.array([ move ]))
+        model.move(move)
+    assert batch.states[0] == model.cstate
+    assert np.allclose(batch.config[0], model.config)